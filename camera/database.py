@@ -1,22 +1,71 @@
+import hashlib
 import boto3
-import json
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+import orjson
 import os
+import threading
 import time
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Union
 from decimal import Decimal
 
 # .env loading is handled in server.py, but for standalone test we might need it.
 # Assuming server.py loads .env before importing or using this class.
 
+# 集計用アイテムのパーティションキー（通常の廃棄ログと同じテーブルに同居させる）
+STATS_USER_ID = "__stats__"
+STATS_GLOBAL_KEY = "global"
+STATS_DAILY_PREFIX = "daily#"
+STATS_REASON_PREFIX = "reason#"
+
+# バッチ書き込み (batch_writes=True) 時のフラッシュ条件
+BATCH_MAX_ITEMS = 25  # BatchWriteItem 1リクエストの上限
+BATCH_MAX_AGE_SECONDS = 1.0
+
+# 同一内容のレコードが連続した場合に重複とみなす時間幅（再送・二重通知対策）
+DUPLICATE_WINDOW_SECONDS = 5.0
+
+
+def _to_int(value: Any) -> int:
+    """DynamoDBのDecimalをintに変換"""
+    return int(value) if value is not None else 0
+
+
+@lru_cache(maxsize=None)
+def _get_table(table_name: str, region_name: str):
+    """DynamoDB Tableリソースをプロセス内で共有する（Database()を何度生成してもboto3の初期化は1回）"""
+    dynamodb = boto3.session.Session().resource('dynamodb', region_name=region_name)
+    return dynamodb.Table(table_name)
+
+
 class Database:
-    def __init__(self):
+    def __init__(self, batch_writes: bool = False):
+        """
+        Parameters:
+            batch_writes: Trueの場合、insert_recordはバッファに溜めて
+                BatchWriteItemでまとめて書き込む（flush_due()を見て呼び出し側がflush()で確定）。
+                書き込み直後に update_record_message を呼ぶ用途では使わないこと。
+        """
         self.region_name = os.getenv("AWS_DEFAULT_REGION", "ap-northeast-1")
         self.table_name = os.getenv("DYNAMODB_TABLE_NAME", "waste_disposal_history")
         
-        # Initialize DynamoDB resource
-        self.dynamodb = boto3.resource('dynamodb', region_name=self.region_name)
-        self.table = self.dynamodb.Table(self.table_name)
+        # Initialize DynamoDB resource (shared across instances)
+        self.table = _get_table(self.table_name, self.region_name)
+
+        # raw_json は他の属性と重複するバックアップ用なので、不要なら無効化できる
+        self.store_raw_json = os.getenv("DYNAMODB_STORE_RAW_JSON", "true").lower() == "true"
+
+        self._last_content_hash: Optional[bytes] = None
+        self._last_insert_time = 0.0
+
+        self.batch_writes = batch_writes
+        self._batch_lock = threading.Lock()
+        self._pending_items = []
+        self._pending_global: Dict[str, int] = {}
+        self._pending_daily: Dict[str, Dict[str, int]] = {}
+        self._batch_started_at = 0.0
         
         print(f"Database initialized: DynamoDB Table '{self.table_name}' in '{self.region_name}'")
 
@@ -25,14 +74,33 @@ class Database:
                       result_json: Dict[str, Any], 
                       user_id: Optional[str] = "webapp_user",
                       rejection_reason: Optional[str] = None,
-                      timestamp: Optional[str] = None):
-        """Insert a new disposal record into DynamoDB."""
+                      timestamp: Optional[str] = None,
+                      raw_json: Optional[Union[str, bytes]] = None) -> bool:
+        """Insert a new disposal record into DynamoDB.
+
+        raw_json: 元のJSON文字列（またはバイト列）が手元にある場合に渡すと、
+            result_json を再シリアライズせずそのまま保存する。
+
+        Returns: 書き込んだ（batch_writes時はバッファに積んだ）場合True、
+            重複スキップや保存エラーで書き込まなかった場合False。
+        """
         
         # Extract relevant fields
         is_valid = result_json.get("is_valid", False)
         message = result_json.get("message", "")
         detected_items = result_json.get("detected_items", [])
         
+        # 直前と同じ内容が短時間に届いた場合は重複として書き込まない
+        content_hash = hashlib.blake2b(
+            orjson.dumps([image_path, is_valid, sorted(map(str, detected_items)), message]),
+            digest_size=16
+        ).digest()
+        now = time.monotonic()
+        if (content_hash == self._last_content_hash
+                and now - self._last_insert_time < DUPLICATE_WINDOW_SECONDS):
+            print(f"⏭️ 重複レコードのため保存をスキップしました: {image_path}")
+            return False
+
         # Timestamp for Sort Key
         if not timestamp:
             JST = timezone(timedelta(hours=9))
@@ -45,20 +113,125 @@ class Database:
             'detected_items': detected_items,
             'is_valid': is_valid,
             'rejection_reason': rejection_reason,
-            'message': message,
-            'raw_json': json.dumps(result_json, ensure_ascii=False)
+            'message': message
         }
+        if self.store_raw_json:
+            if raw_json is None:
+                raw_json = orjson.dumps(result_json).decode("utf-8")
+            elif isinstance(raw_json, bytes):
+                raw_json = raw_json.decode("utf-8")
+            item['raw_json'] = raw_json
         
         # Remove None values (DynamoDB doesn't like them sometimes, or optional)
         # Actually boto3 handles None as NULL, but empty strings are not allowed in some cases.
         # Let's clean up.
         item = {k: v for k, v in item.items() if v is not None}
 
+        if self.batch_writes:
+            with self._batch_lock:
+                if not self._pending_items:
+                    self._batch_started_at = time.monotonic()
+                self._pending_items.append(item)
+                self._accumulate_stats(self._pending_global, self._pending_daily,
+                                       timestamp, is_valid, rejection_reason)
+            self._last_content_hash = content_hash
+            self._last_insert_time = now
+            return True
+
         try:
             self.table.put_item(Item=item)
             print(f"✅ DynamoDBに記録しました: {user_id} - {timestamp}")
         except Exception as e:
             print(f"❌ DynamoDB保存エラー: {e}")
+            return False
+        # 重複判定は書き込みに成功してから更新する（失敗後の再送を重複扱いしない）
+        self._last_content_hash = content_hash
+        self._last_insert_time = now
+
+        global_delta, daily_deltas = {}, {}
+        self._accumulate_stats(global_delta, daily_deltas, timestamp, is_valid, rejection_reason)
+        self._apply_stats(global_delta, daily_deltas)
+        return True
+
+    def flush_due(self) -> bool:
+        """バッファが件数上限または経過時間の上限に達していればTrue"""
+        with self._batch_lock:
+            if not self._pending_items:
+                return False
+            return (len(self._pending_items) >= BATCH_MAX_ITEMS
+                    or time.monotonic() - self._batch_started_at >= BATCH_MAX_AGE_SECONDS)
+
+    def flush(self) -> bool:
+        """バッファ済みのレコードをBatchWriteItemでまとめて書き込む
+
+        Returns: 書き込めた（またはバッファが空だった）場合True。失敗した分は破棄されるため、
+            呼び出し側は元のメッセージを再処理させること（SQSなら削除しない）。
+        """
+        with self._batch_lock:
+            items = self._pending_items
+            global_delta = self._pending_global
+            daily_deltas = self._pending_daily
+            self._pending_items = []
+            self._pending_global = {}
+            self._pending_daily = {}
+
+        if not items:
+            return True
+
+        try:
+            # batch_writer は25件ごとにリクエストを分割し、未処理分も再送する
+            with self.table.batch_writer() as batch:
+                for item in items:
+                    batch.put_item(Item=item)
+            print(f"✅ DynamoDBに{len(items)}件まとめて記録しました")
+        except Exception as e:
+            print(f"❌ DynamoDB一括保存エラー: {e}")
+            return False
+
+        self._apply_stats(global_delta, daily_deltas)
+        return True
+
+    @staticmethod
+    def _accumulate_stats(global_delta: Dict[str, int],
+                          daily_deltas: Dict[str, Dict[str, int]],
+                          timestamp: str,
+                          is_valid: bool,
+                          rejection_reason: Optional[str]):
+        """1レコード分の集計値を差分に加算する"""
+        date_str = timestamp.split('T')[0] if 'T' in timestamp else 'Unknown'
+        result_key = 'ok' if is_valid else 'ng'
+
+        global_delta['total'] = global_delta.get('total', 0) + 1
+        global_delta[result_key] = global_delta.get(result_key, 0) + 1
+        if not is_valid and rejection_reason:
+            reason_key = f"{STATS_REASON_PREFIX}{rejection_reason}"
+            global_delta[reason_key] = global_delta.get(reason_key, 0) + 1
+
+        day = daily_deltas.setdefault(date_str, {})
+        day[result_key] = day.get(result_key, 0) + 1
+
+    def _apply_stats(self, global_delta: Dict[str, int], daily_deltas: Dict[str, Dict[str, int]]):
+        """集計アイテム（全体・日別）をアトミックカウンターで加算する"""
+        try:
+            self._add_counters(STATS_GLOBAL_KEY, global_delta)
+            for date_str, day in daily_deltas.items():
+                self._add_counters(f"{STATS_DAILY_PREFIX}{date_str}", day)
+        except Exception as e:
+            print(f"❌ 統計更新エラー: {e}")
+
+    def _add_counters(self, stats_key: str, delta: Dict[str, int]):
+        """集計アイテムの各属性に ADD で差分を加える"""
+        if not delta:
+            return
+        names = {f"#a{i}": attr for i, attr in enumerate(delta)}
+        values = {f":v{i}": count for i, count in enumerate(delta.values())}
+        expression = "ADD " + ", ".join(f"#a{i} :v{i}" for i in range(len(delta)))
+        self.table.update_item(
+            Key={'user_id': STATS_USER_ID, 'timestamp': stats_key},
+            UpdateExpression=expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
 
     def update_record_message(self, user_id: str, timestamp: str, new_message: str):
         """Update the message of an existing record."""
@@ -69,11 +242,18 @@ class Database:
                     'timestamp': timestamp
                 },
                 UpdateExpression="set message = :m",
+                # 存在しないレコードを message だけのアイテムとして作らない
+                ConditionExpression="attribute_exists(user_id)",
                 ExpressionAttributeValues={
                     ':m': new_message
                 }
             )
             print(f"✅ DynamoDBメッセージ更新: {timestamp} -> {new_message}")
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                print(f"⏭️ 更新対象のレコードがないためスキップしました: {timestamp}")
+            else:
+                print(f"❌ DynamoDB更新エラー: {e}")
         except Exception as e:
             print(f"❌ DynamoDB更新エラー: {e}")
 
@@ -81,7 +261,7 @@ class Database:
         """Fetch recent records for a user."""
         try:
             response = self.table.query(
-                KeyConditionExpression=boto3.dynamodb.conditions.Key('user_id').eq(user_id),
+                KeyConditionExpression=Key('user_id').eq(user_id),
                 ScanIndexForward=False, # Descending order
                 Limit=limit
             )
@@ -93,49 +273,41 @@ class Database:
             print(f"❌ DynamoDB取得エラー: {e}")
             return []
 
-    def get_stats(self):
+    def get_stats(self, user_id: str = "webapp_user"):
         """
-        全データをスキャンして統計情報を取得する
-        (デモ用なので全件スキャンでOK)
+        集計アイテムから統計情報を取得する
+        (全件スキャンせず、GetItem + 範囲が限られたQueryのみで組み立てる)
         """
         try:
-            # 全件スキャン (件数が多すぎると遅くなるがデモならOK)
-            response = self.table.scan()
-            items = response.get('Items', [])
-            
-            total_ok = 0
-            total_ng = 0
-            reasons = {}
-            daily_stats = {}
-
-            for item in items:
-                is_valid = item.get('is_valid', False)
-                timestamp = item.get('timestamp', '')
-                
-                # 日付の抽出 (ISOフォーマット想定: YYYY-MM-DD...)
-                date_str = timestamp.split('T')[0] if 'T' in timestamp else 'Unknown'
-
-                if date_str not in daily_stats:
-                    daily_stats[date_str] = {'ok': 0, 'ng': 0}
-
-                if is_valid:
-                    total_ok += 1
-                    daily_stats[date_str]['ok'] += 1
-                else:
-                    total_ng += 1
-                    daily_stats[date_str]['ng'] += 1
-                    reason = item.get('rejection_reason')
-                    if reason:
-                        reasons[reason] = reasons.get(reason, 0) + 1
-            
-            # 日付順にソート
-            sorted_daily = dict(sorted(daily_stats.items()))
-
-            # 最新のログを取得 (タイムスタンプで降順ソートして先頭10件)
-            # itemsはscanで取得しているので順序保証なし -> ソートが必要
-            sorted_items = sorted(items, key=lambda x: x.get('timestamp', ''), reverse=True)[:10]
+            response = self.table.get_item(
+                Key={'user_id': STATS_USER_ID, 'timestamp': STATS_GLOBAL_KEY}
+            )
+            # 集計アイテム導入前のデータは backfill_stats で一度だけ取り込む（ここでは再構築しない）
+            global_stats = response.get('Item', {})
+
+            reasons = {
+                k[len(STATS_REASON_PREFIX):]: _to_int(v)
+                for k, v in global_stats.items()
+                if k.startswith(STATS_REASON_PREFIX) and _to_int(v) > 0
+            }
+
+            # 日別集計 (SortKeyが "daily#YYYY-MM-DD" なので昇順Queryでそのまま日付順)
+            daily_response = self.table.query(
+                KeyConditionExpression=Key('user_id').eq(STATS_USER_ID)
+                & Key('timestamp').begins_with(STATS_DAILY_PREFIX)
+            )
+            sorted_daily = {
+                item['timestamp'][len(STATS_DAILY_PREFIX):]: {
+                    'ok': _to_int(item.get('ok')),
+                    'ng': _to_int(item.get('ng')),
+                }
+                for item in daily_response.get('Items', [])
+            }
+
+            # 最新のログ (user_id のパーティションをSortKey降順で先頭10件のみ取得)
+            # 全ユーザー横断ではなく、webapp・SQS連携とも書き込む webapp_user が対象
             recent_logs = []
-            for item in sorted_items:
+            for item in self.get_recent_records(user_id=user_id, limit=10):
                 recent_logs.append({
                     'timestamp': item.get('timestamp', ''),
                     'is_valid': item.get('is_valid', False),
@@ -144,9 +316,9 @@ class Database:
                 })
 
             return {
-                "total": len(items),
-                "ok": total_ok,
-                "ng": total_ng,
+                "total": _to_int(global_stats.get('total')),
+                "ok": _to_int(global_stats.get('ok')),
+                "ng": _to_int(global_stats.get('ng')),
                 "reasons": reasons,
                 "daily": sorted_daily,
                 "recent_logs": recent_logs
@@ -155,11 +327,82 @@ class Database:
             print(f"❌ 統計取得エラー: {e}")
             return {"total": 0, "ok": 0, "ng": 0, "reasons": {}, "daily": {}, "recent_logs": []}
 
+    def backfill_stats(self, before: str):
+        """
+        集計アイテム導入前のレコードを集計アイテムに加算する（一度きりのデータ移行用）
+
+        Parameters:
+            before: 集計アイテム導入（デプロイ）時刻のISO文字列。
+                これより前のタイムスタンプのレコードだけを数える（以降は insert_record が加算済み）。
+
+        稼働中のカウンターは上書きせず ADD で加算し、各集計アイテムに migrated 属性を
+        条件付きで付けるため、途中で失敗しても再実行で二重加算されない。
+        """
+        global_delta: Dict[str, int] = {}
+        daily_deltas: Dict[str, Dict[str, int]] = {}
+
+        scan_kwargs = {}
+        while True:
+            response = self.table.scan(**scan_kwargs)
+            for item in response.get('Items', []):
+                if item.get('user_id') == STATS_USER_ID:
+                    continue
+                timestamp = item.get('timestamp', '')
+                if timestamp >= before:
+                    continue
+                self._accumulate_stats(global_delta, daily_deltas, timestamp,
+                                       item.get('is_valid', False), item.get('rejection_reason'))
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        applied = 0
+        for date_str, day in daily_deltas.items():
+            applied += self._backfill_counters(f"{STATS_DAILY_PREFIX}{date_str}", day, before)
+        applied += self._backfill_counters(STATS_GLOBAL_KEY, global_delta, before)
+        print(f"✅ 統計を移行しました: {global_delta.get('total', 0)}件 "
+              f"(集計アイテム {applied}/{len(daily_deltas) + 1} 件を更新)")
+
+    def _backfill_counters(self, stats_key: str, delta: Dict[str, int], marker: str) -> int:
+        """migrated 属性が未設定の集計アイテムにだけ差分を ADD する（更新した場合は1を返す）"""
+        if not delta:
+            return 0
+        names = {f"#a{i}": attr for i, attr in enumerate(delta)}
+        values = {f":v{i}": count for i, count in enumerate(delta.values())}
+        names["#m"] = "migrated"
+        values[":m"] = marker
+        expression = ("ADD " + ", ".join(f"#a{i} :v{i}" for i in range(len(delta)))
+                      + " SET #m = :m")
+        try:
+            self.table.update_item(
+                Key={'user_id': STATS_USER_ID, 'timestamp': stats_key},
+                UpdateExpression=expression,
+                ConditionExpression="attribute_not_exists(#m)",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                print(f"⏭️ 移行済みのためスキップしました: {stats_key}")
+                return 0
+            raise
+        return 1
+
 if __name__ == "__main__":
     # Simple test
     # Note: Requires AWS credentials to be set in environment
+    # 集計アイテム導入前のデータ移行: python database.py --backfill-stats <導入時刻のISO文字列>
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill-stats", metavar="BEFORE",
+                        help="このISOタイムスタンプより前のレコードを集計アイテムに加算する（一度きり）")
+    args = parser.parse_args()
     try:
         db = Database()
         print("DynamoDB connection initialized.")
     except Exception as e:
         print(f"Initialization failed: {e}")
+        raise SystemExit(1)
+    if args.backfill_stats:
+        db.backfill_stats(args.backfill_stats)
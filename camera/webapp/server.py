@@ -3,55 +3,79 @@ WebSocket Relay Server for OpenAI Realtime API
 ゴミ箱カメラ/ARクライアントとOpenAI間の橋渡しを行うサーバー
 """
 import asyncio
-import base64
 import datetime
 from datetime import timezone, timedelta
 import hashlib
-import json
 import logging
+import mmap
 import os
+import queue
 import re
+import secrets
 import struct
 import sys
 import struct
 import sys
+import string
 import signal  # Added for SIGTERM/SIGKILL
+import ssl
 # import atexit removed
-from functools import partial
-from collections import OrderedDict
-from typing import Any, Dict, Optional
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Any, BinaryIO, Dict, Optional, Union
 import threading
+import time
 
 from contextlib import asynccontextmanager
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from websockets.asyncio.client import connect
+import orjson
+import pybase64
 
 # 親ディレクトリのモジュールをインポートできるようにパスを追加
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from database import Database
 import subprocess
 import shutil
-import cv2
-import numpy as np
 
 # =============================================================================
 # 定数定義
 # =============================================================================
 
 # 画像処理関連
-IMAGE_DIFF_THRESHOLD: float = 30.0  # 画像差分の閾値
-IMAGE_RESIZE_SIZE: tuple = (64, 64)  # 差分計算用リサイズサイズ
+IMAGE_HASH_SIZE: int = 8  # 平均ハッシュの一辺（8x8 = 64ビット）
+IMAGE_HASH_DISTANCE_THRESHOLD: int = 10  # 変化ありとみなすハミング距離の閾値
 MAX_BASE64_SIZE: int = 10 * 1024 * 1024  # Base64の最大サイズ (10MB)
+MAX_IMAGE_BYTES: int = MAX_BASE64_SIZE // 4 * 3  # バイナリフレームで受け取るJPEGの最大サイズ（Base64上限と同等）
+ENABLE_DIFF_CHECK: bool = False  # OpenCVによる画像差分チェック（無効時はJPEGをデコードしない）
 
 # 音声処理関連
 AUDIO_SAMPLE_RATE: int = 24000
 AUDIO_BYTE_RATE: int = 48000
 AUDIO_CHANNELS: int = 1
 AUDIO_BITS_PER_SAMPLE: int = 16
+AUDIO_PLAYBACK_QUEUE_SIZE: int = 1024  # Macスピーカー再生待ちチャンクの上限（応答音声は実時間より速く届くため余裕を持たせる）
+AUDIO_PLAYBACK_WRITE_MAX: int = 8192  # 再生スレッドが1回のwriteにまとめる最大バイト数（約170ms分）
+
+# WAVヘッダー（44バイト）。フォーマットは固定なので起動時に一度だけ組み立て、
+# RIFF/dataのサイズ欄（オフセット4と40）だけを音声終了時に更新する
+_WAV_HEADER_TEMPLATE: bytes = (
+    b"RIFF" + b"\x00\x00\x00\x00" + b"WAVE" + b"fmt "
+    + struct.pack("<IHHIIHH", 16, 1, AUDIO_CHANNELS,
+                  AUDIO_SAMPLE_RATE, AUDIO_BYTE_RATE,
+                  AUDIO_CHANNELS * AUDIO_BITS_PER_SAMPLE // 8,
+                  AUDIO_BITS_PER_SAMPLE)
+    + b"data" + b"\x00\x00\x00\x00"
+)
+_UINT32_LE = struct.Struct("<I")
+
+# ファイル名・DBタイムスタンプ用のタイムゾーン（呼び出しごとに生成しない）
+JST = timezone(timedelta(hours=9))
 
 # 再接続関連
 RECONNECT_BASE_DELAY: float = 1.0
@@ -62,6 +86,17 @@ MAX_RECONNECT_ATTEMPTS: int = 10
 # AI発話フラグクリア遅延
 AI_SPEAKING_CLEAR_DELAY: float = 0.2
 
+# クライアント送信キュー関連
+CLIENT_SEND_QUEUE_SIZE: int = 512  # 1クライアントあたりの未送信メッセージ上限
+CLIENT_SEND_BATCH_MAX: int = 32  # ライターが一度に取り出す最大件数
+
+# OpenAI送信バッチ関連
+OPENAI_SEND_BATCH_MAX: int = 16  # 一度にキューから取り出す最大イベント数
+OPENAI_QUEUE_MAXSIZE: int = 256  # 送信待ちイベントの上限（超えたら古いものから破棄）
+
+# ファイルI/O・画像デコード用スレッドプール
+IO_POOL_MAX_WORKERS: int = 4
+
 # =============================================================================
 # 環境設定
 # =============================================================================
@@ -74,10 +109,19 @@ if sys.stdout.encoding != 'utf-8':
     sys.stdout.reconfigure(encoding='utf-8')
 
 
+# safe_float の高速判定用（符号付きの10進数表記）
+_FLOAT_RE = re.compile(r"-?\d+(\.\d+)?")
+
+
 def safe_int(value: Optional[str], default: int) -> int:
     """安全に文字列をintに変換"""
     if value is None:
         return default
+    # よくある整数表記は例外を発生させずに変換する
+    if isinstance(value, str):
+        value = value.strip()
+        if value.isascii() and value.removeprefix("-").isdigit():
+            return int(value)
     try:
         return int(value)
     except (ValueError, TypeError):
@@ -88,15 +132,22 @@ def safe_float(value: Optional[str], default: float) -> float:
     """安全に文字列をfloatに変換"""
     if value is None:
         return default
+    if isinstance(value, str):
+        value = value.strip()
+        if _FLOAT_RE.fullmatch(value):
+            return float(value)
     try:
         return float(value)
     except (ValueError, TypeError):
         return default
 
 
-# ロガー設定
+# ロガー設定（本番でINFOログを止めたい場合は LOG_LEVEL=WARNING）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+if LOG_LEVEL not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+    LOG_LEVEL = "INFO"
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL,
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
 )
 LOGGER = logging.getLogger("webapp")
@@ -106,14 +157,30 @@ hub: Optional['RelayHub'] = None
 async def lifespan(app: FastAPI):
     # 起動時
     global hub
+    if _LOOP_CPUS:
+        # サーボ制御などで使う既定プールのスレッドもI/O用CPUへ
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(thread_name_prefix="default", initializer=_pin_io_thread))
     hub = RelayHub()
     LOGGER.info("RelayHub initialized")
+    if _LOOP_CPUS:
+        # イベントループのスレッドを固定（以降に生成されるスレッドはこの設定を引き継ぐため、
+        # Obnizブリッジのサブプロセスと出力転送スレッドを起動した後に行う）
+        os.sched_setaffinity(0, _LOOP_CPUS)
+        LOGGER.info("CPU affinity: loop=%s io=%s", sorted(_LOOP_CPUS), sorted(_IO_CPUS))
     LOGGER.info("AUDIO_ENDPOINT=%s", AUDIO_ENDPOINT)
+    # 最初のクライアントを待たずにOpenAIへ接続しておく（接続前に届いた画像・音声は破棄されるため）
+    await hub.ensure_openai_task()
     yield
     # 終了時
     if hub:
         hub.cleanup()
         LOGGER.info("RelayHub cleaned up")
+    _io_pool.shutdown(wait=False)
+    # 書きかけのWAVヘッダーは確定させてから終了する
+    _wav_pool.shutdown(wait=True)
+    # 未送信の判定ログは書き切ってから終了する
+    _db_pool.shutdown(wait=True)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -127,11 +194,13 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = os.getenv("REALTIME_MODEL", "gpt-realtime-mini")
 VOICE = os.getenv("REALTIME_VOICE", "verse")
 URL = f"wss://api.openai.com/v1/realtime?model={MODEL}"
+# 再接続のたびにCA証明書を読み直さないよう、TLSコンテキストは共有する
+OPENAI_SSL_CONTEXT = ssl.create_default_context()
 
 # WebSocket認証トークン (環境変数から取得、未設定の場合はランダム生成)
 WS_AUTH_TOKEN = os.getenv("WS_AUTH_TOKEN")
 if not WS_AUTH_TOKEN:
-    WS_AUTH_TOKEN = hashlib.sha256(os.urandom(32)).hexdigest()[:32]
+    WS_AUTH_TOKEN = secrets.token_hex(16)
     # セキュリティのため部分マスク表示
     masked_token = f"{WS_AUTH_TOKEN[:4]}{'*' * 24}{WS_AUTH_TOKEN[-4:]}"
     LOGGER.warning("WS_AUTH_TOKEN not set. Generated token (masked): %s", masked_token)
@@ -142,6 +211,9 @@ if AUDIO_ENDPOINT not in {"camera", "ar"}:
     LOGGER.warning("AUDIO_ENDPOINT は camera か ar を指定してください。デフォルトの camera を使用します。")
     AUDIO_ENDPOINT = "camera"
 
+# AI音声をcaptured_audioにWAV保存するか（無効かつMacスピーカー未使用ならbase64デコード自体を省略）
+SAVE_AUDIO = os.getenv("SAVE_AUDIO", "true").lower() == "true"
+
 # 環境変数の読み込み（安全なパース）
 DETECTION_DELAY = safe_int(os.getenv("DETECTION_DELAY"), 5)
 IMAGE_INTERVAL = safe_int(os.getenv("IMAGE_INTERVAL"), 15)
@@ -158,25 +230,143 @@ if not OPENAI_API_KEY:
 # データベース
 db = Database()
 
+# CPUアフィニティ（Linuxのみ・オプトイン）: イベントループを先頭CPUに、I/O・再生スレッドを残りのCPUに固定
+PIN_CPU_AFFINITY = os.getenv("PIN_CPU_AFFINITY", "false").lower() == "true"
+_LOOP_CPUS: Optional[set] = None
+_IO_CPUS: Optional[set] = None
+if PIN_CPU_AFFINITY:
+    if hasattr(os, "sched_setaffinity"):
+        _cpus = sorted(os.sched_getaffinity(0))
+        if len(_cpus) >= 2:
+            _LOOP_CPUS, _IO_CPUS = {_cpus[0]}, set(_cpus[1:])
+        else:
+            LOGGER.warning("PIN_CPU_AFFINITY requires 2+ CPUs. Ignored.")
+    else:
+        LOGGER.warning("PIN_CPU_AFFINITY is only supported on Linux. Ignored.")
+
+
+def _pin_io_thread():
+    """呼び出したスレッドをI/O用CPUに固定（ThreadPoolExecutorのinitializer用）"""
+    if _IO_CPUS:
+        os.sched_setaffinity(0, _IO_CPUS)
+
+
+# 画像・音声のファイルI/O専用プール（既定プールをDB書き込みやサーボ制御と奪い合わないよう分離）
+_io_pool = ThreadPoolExecutor(max_workers=IO_POOL_MAX_WORKERS, thread_name_prefix="img-io",
+                              initializer=_pin_io_thread)
+
+def _log_background_error(what: str, future) -> None:
+    """完了を待たずに投げたI/Oの例外をログに残す（add_done_callback用）"""
+    error = future.exception()
+    if error is not None:
+        LOGGER.error("%s failed: %s", what, error, exc_info=error)
+
+
+# WAV保存専用の単一スレッド（チャンク追記とヘッダー確定が同じファイルに並行して触れないよう直列化）
+_wav_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wav-io", initializer=_pin_io_thread)
+
+# DB書き込み専用の単一スレッド（投入順に実行されるので、記録→トランスクリプト更新の順序が崩れない）
+_db_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db", initializer=_pin_io_thread)
+
 
 # =============================================================================
 # ユーティリティ関数
 # =============================================================================
 
+# item_id に許可する文字（英数字、ハイフン、アンダースコア）以外を "_" に置換する変換表
+_ITEM_ID_ALLOWED = frozenset(string.ascii_letters + string.digits + "_-")
+_ITEM_ID_TRANS = str.maketrans({chr(i): "_" for i in range(128) if chr(i) not in _ITEM_ID_ALLOWED})
+_ITEM_ID_DISALLOWED_RE = re.compile(r'[^a-zA-Z0-9_-]')
+
+
 def sanitize_item_id(item_id: str) -> str:
     """item_idをサニタイズしてパストラバーサルを防止"""
     if not item_id:
         return "unknown"
-    # 英数字、ハイフン、アンダースコアのみ許可
-    sanitized = re.sub(r'[^a-zA-Z0-9_-]', '_', item_id)
-    # 長さ制限
-    return sanitized[:64]
+    # 長さ制限を先に適用し、ASCIIのみなら変換表で一括置換
+    item_id = item_id[:64]
+    if item_id.isascii():
+        return item_id.translate(_ITEM_ID_TRANS)
+    return _ITEM_ID_DISALLOWED_RE.sub('_', item_id)
+
 
+def encode_file_base64(filepath: str) -> str:
+    """ファイルをmmapし、中間のbytesコピーを作らずにBase64エンコード"""
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return pybase64.b64encode_as_string(mm)
 
-def generate_idempotency_key(call_id: str, args_str: str) -> str:
+
+def generate_idempotency_key(call_id: str, args_str: str) -> int:
     """Function Callの冪等性キーを生成"""
+    # 暗号強度は不要なので、8バイトダイジェストのblake2bを64ビット整数のまま使う（16進文字列化しない）
     content = f"{call_id}:{args_str}"
-    return hashlib.sha256(content.encode()).hexdigest()[:16]
+    return int.from_bytes(hashlib.blake2b(content.encode(), digest_size=8).digest(), "big")
+
+
+def _coalesce_audio_appends(events: list) -> list:
+    """連続する input_audio_buffer.append を1イベントに結合（順序は維持）"""
+    result = []
+    pending_audio = []
+
+    def flush_audio():
+        if len(pending_audio) == 1:
+            result.append({"type": "input_audio_buffer.append", "audio": pending_audio[0]})
+        elif pending_audio:
+            joined = b"".join(pybase64.b64decode(a, validate=False) for a in pending_audio)
+            result.append({
+                "type": "input_audio_buffer.append",
+                "audio": pybase64.b64encode_as_string(joined),
+            })
+        pending_audio.clear()
+
+    for event in events:
+        if (isinstance(event, dict) and event.get("type") == "input_audio_buffer.append"
+                and len(event) == 2 and "audio" in event):
+            pending_audio.append(event["audio"])
+            continue
+        flush_audio()
+        result.append(event)
+    flush_audio()
+    return result
+
+
+def _event_type(event: Union[dict, str, tuple]) -> Optional[str]:
+    """キュー要素（単一イベント or イベントのtuple）の先頭イベントのtypeを返す
+
+    受信文字列のまま転送するイベント（str）はパースしていないためNoneを返す
+    """
+    if isinstance(event, tuple):
+        event = event[0] if event else {}
+    if isinstance(event, str):
+        return None
+    return event.get("type")
+
+
+# 画像送信直後に続けて送るレスポンス生成トリガー（内容固定）
+_RESPONSE_CREATE_JSON = orjson.dumps({"type": "response.create"}).decode()
+
+
+@lru_cache(maxsize=32)
+def _servo_command(angle: int) -> bytes:
+    """obniz_bridge.js に送るサーボコマンド行（角度ごとにキャッシュ）"""
+    return orjson.dumps({"angle": angle}) + b"\n"
+
+
+# 画像判定リクエストの固定コンテンツ（毎フレーム同じなので使い回す。変更しないこと）
+_CURRENT_IMAGE_LABEL_ITEM: Dict[str, str] = {"type": "input_text", "text": "【現在の画像】"}
+# プロンプトを少し調整して、比較指示を含める
+_IMAGE_INSTRUCTION_ITEM: Dict[str, str] = {
+    "type": "input_text",
+    "text": (
+        "画像判定を行い、必ず log_disposal を呼び出してください。"
+        "【注意】画像が送られてきた場合は、絶対に雑談だけで終わらせず、必ず log_disposal 関数を実行して判定結果を記録してください。"
+        "【基準画像】と【現在の画像】を比較し、明らかに新しいゴミがない（空のまま）場合は、"
+        "result='NG', rejection_reason='wrong_item' (空) と判定してください。"
+    ),
+}
 
 
 # =============================================================================
@@ -188,8 +378,10 @@ class SpeakingState:
 
     def __init__(self):
         self._speaking = False
-        self._lock = asyncio.Lock()
-        self._clear_task: Optional[asyncio.Task] = None
+        # 発話フラグをクリアする時刻（loop.time()基準）。Noneならクリア予定なし
+        self._deadline: Optional[float] = None
+        self._wake = asyncio.Event()
+        self._timer_task: Optional[asyncio.Task] = None
 
     @property
     def is_speaking(self) -> bool:
@@ -197,35 +389,88 @@ class SpeakingState:
 
     async def start_speaking(self):
         """発話開始"""
-        async with self._lock:
-            # 既存のクリアタスクをキャンセル
-            if self._clear_task and not self._clear_task.done():
-                self._clear_task.cancel()
-                try:
-                    await self._clear_task
-                except asyncio.CancelledError:
-                    pass
-            self._speaking = True
+        # 予約済みのクリアを取り消す（タイマー側は期限なしとして扱う）
+        self._deadline = None
+        self._speaking = True
 
     async def stop_speaking(self, delay: float = AI_SPEAKING_CLEAR_DELAY):
         """発話終了（遅延付き）"""
-        async with self._lock:
-            # 既存のクリアタスクをキャンセル
-            if self._clear_task and not self._clear_task.done():
-                self._clear_task.cancel()
-                try:
-                    await self._clear_task
-                except asyncio.CancelledError:
-                    pass
-            self._clear_task = asyncio.create_task(self._delayed_clear(delay))
+        loop = asyncio.get_running_loop()
+        self._deadline = loop.time() + delay
+        if self._timer_task is None or self._timer_task.done():
+            # 常駐タイマーは1つだけ起動し、以降は期限の更新のみ行う
+            self._timer_task = asyncio.create_task(self._timer_loop())
+        self._wake.set()
+
+    async def _timer_loop(self):
+        """期限に達したらフラグをクリアする常駐タスク"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._deadline is not None:
+                remaining = self._deadline - loop.time()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                    continue
+                self._speaking = False
+                self._deadline = None
 
-    async def _delayed_clear(self, delay: float):
-        """遅延後にフラグをクリア"""
-        try:
-            await asyncio.sleep(delay)
-            self._speaking = False
-        except asyncio.CancelledError:
-            pass
+
+# =============================================================================
+# OpenAI送信キュー
+# =============================================================================
+
+class OpenAISendQueue:
+    """OpenAIへの送信待ちイベントのキュー
+
+    溢れた場合はマイク音声（input_audio_buffer.append）だけを古い順に捨てる。
+    画像・response.create等の制御イベントは捨てず、空きが出るまで待たせる。
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: deque = deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def empty(self) -> bool:
+        return not self._items
+
+    async def put(self, item: Union[dict, str, tuple]) -> bool:
+        """追加する。音声イベント自体を捨てた場合のみFalseを返す"""
+        while len(self._items) >= self.maxsize:
+            if self._drop_oldest_audio():
+                break
+            if _event_type(item) == "input_audio_buffer.append":
+                # 制御イベントで埋まっている間は新しい音声のほうを捨てる
+                return False
+            self._not_full.clear()
+            await self._not_full.wait()
+        self._items.append(item)
+        self._not_empty.set()
+        return True
+
+    async def get(self) -> Union[dict, str, tuple]:
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def get_nowait(self) -> Union[dict, str, tuple]:
+        if not self._items:
+            raise asyncio.QueueEmpty
+        item = self._items.popleft()
+        self._not_full.set()
+        return item
+
+    def _drop_oldest_audio(self) -> bool:
+        for index, item in enumerate(self._items):
+            if _event_type(item) == "input_audio_buffer.append":
+                del self._items[index]
+                return True
+        return False
 
 
 # =============================================================================
@@ -260,42 +505,100 @@ async def get_dashboard():
     return FileResponse(os.path.join(static_dir, "dashboard.html"))
 
 
-@app.get("/api/latest-image")
-async def get_latest_image():
-    """最新の判定画像を返す"""
-    # captured_imagesディレクトリから最新のファイルを取得
+# /api/latest-image 用の最新ファイル名キャッシュ（captured_images の mtime で無効化）
+_latest_image_cache: Dict[str, Any] = {"mtime_ns": None, "name": None}
+
+
+def _find_latest_image() -> tuple:
+    """captured_imagesの最新ファイルを (ディレクトリ, ファイル名 or None) で返す"""
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     image_dir = os.path.join(base_dir, "captured_images")
 
-    if not os.path.exists(image_dir):
+    # ディレクトリがない場合はFileNotFoundErrorを呼び出し元へ送出
+    mtime_ns = os.stat(image_dir).st_mtime_ns
+
+    # ディレクトリに変更があった時だけ再スキャンする
+    if _latest_image_cache["mtime_ns"] != mtime_ns:
+        # ファイル名（タイムスタンプ）が最大のjpgを1パスで取得（リスト化・ソートしない）
+        # 書き込み中の一時ファイル（*.jpg.tmp）は拡張子で除外される
+        with os.scandir(image_dir) as it:
+            latest_name = max(
+                (e.name for e in it if e.name.endswith(".jpg")), default=None
+            )
+        _latest_image_cache["mtime_ns"] = mtime_ns
+        _latest_image_cache["name"] = latest_name
+
+    return image_dir, _latest_image_cache["name"]
+
+
+def _image_etag(filename: str) -> str:
+    # ファイル名はタイムスタンプで一意なのでそのままETagに使う
+    return f'"{filename}"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+@app.get("/api/latest-image")
+async def get_latest_image(request: Request):
+    """最新の判定画像を返す"""
+    try:
+        image_dir, latest_file = _find_latest_image()
+    except FileNotFoundError:
         return {"error": "No images directory", "image": None}
 
-    # jpgファイルを更新日時でソート
-    files = [f for f in os.listdir(image_dir) if f.endswith(".jpg")]
-    if not files:
+    if not latest_file:
         return {"error": "No images found", "image": None}
 
-    # ファイル名（タイムスタンプ）でソートして最新を取得
-    files.sort(reverse=True)
-    latest_file = files[0]
+    # 画像が変わっていなければBase64エンコードせず304を返す
+    etag = _image_etag(latest_file)
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers)
+
     filepath = os.path.join(image_dir, latest_file)
 
-    # Base64エンコードして返す
+    # Base64エンコードして返す（イベントループを止めないようスレッドで実行）
     try:
-        with open(filepath, "rb") as f:
-            image_data = f.read()
-        import base64
-        b64_image = base64.b64encode(image_data).decode("utf-8")
-        return {
+        loop = asyncio.get_running_loop()
+        b64_image = await loop.run_in_executor(_io_pool, encode_file_base64, filepath)
+        return JSONResponse({
             "image": f"data:image/jpeg;base64,{b64_image}",
             "filename": latest_file,
             "timestamp": latest_file.replace(".jpg", "")
-        }
+        }, headers=cache_headers)
     except Exception as e:
         LOGGER.error("Failed to read latest image: %s", e, exc_info=True)
         return {"error": str(e), "image": None}
 
 
+@app.get("/api/latest-image.jpg")
+async def get_latest_image_file(request: Request):
+    """最新の判定画像をJPEGのまま返す（ETagによる304対応）"""
+    try:
+        image_dir, latest_file = _find_latest_image()
+    except FileNotFoundError:
+        latest_file = None
+
+    if not latest_file:
+        return Response(status_code=404)
+
+    etag = _image_etag(latest_file)
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers)
+
+    return FileResponse(
+        os.path.join(image_dir, latest_file),
+        media_type="image/jpeg",
+        headers=cache_headers,
+    )
+
+
 # =============================================================================
 # RelayHub クラス
 # =============================================================================
@@ -305,24 +608,31 @@ class RelayHub:
 
     def __init__(self):
         self.clients: Dict[str, WebSocket] = {}
+        # クライアントごとの送信キューと、それを書き出すライタータスク
+        self.client_queues: Dict[str, asyncio.Queue] = {}
+        self.client_writers: Dict[str, asyncio.Task] = {}
         self.lock = asyncio.Lock()
-        self.to_openai: Optional[asyncio.Queue] = None
+        self.to_openai: Optional[OpenAISendQueue] = None
         self.loop: Optional[asyncio.AbstractEventLoop] = None
         self.speaking_state = SpeakingState()
         self.audio_endpoint = AUDIO_ENDPOINT
         self.use_mac_speaker = os.getenv("USE_MAC_SPEAKER", "false").lower() == "true"
 
-        self.session_state_lock = asyncio.Lock()
+        # session_stateはロックなしで扱う。書き手は次の2タスクのみで、どちらもイベントループ上で動く:
+        #   - handle_client: last_image_time / previous_image_hash / previous_image_digest / skip_next_response
+        #   - _pump_from_openai（handle_function_callを含む）: それ以外の全フィールド
+        # 後者はイベントを1件ずつawaitして処理するため、awaitを跨ぐ読み書きも同じフィールドの書き手と競合しない
+        # 例外: DB挿入が書かれなかった場合、_forget_disposal_timestampがループ上でlast_disposal_timestampを消す
         self._servo_lock = asyncio.Lock()  # サーボ書き込み直列化用
         self.session_state = {
             "last_image_time": 0,
             "last_judgment_time": 0,
-            "previous_image_data": None,
-            "previous_image_cv2": None,
+            "previous_image_hash": None,
+            "previous_image_digest": None,  # 前回画像のJPEGバイト列のダイジェスト（完全一致の判定用）
             "skip_next_response": False,
             "transcript_map": {},
             "last_transcript_info": None,
-            "processed_call_ids": OrderedDict(),  # 処理済みFunction CallのID（順序保持）
+            "processed_call_ids": {},  # 処理済みFunction CallのID（dictの挿入順を利用）
             "last_disposal_timestamp": None,  # 最後に記録した廃棄ログのタイムスタンプ
             "pending_servo_angle": None,  # 発話後に実行するサーボ角度
         }
@@ -334,27 +644,41 @@ class RelayHub:
         os.makedirs(self.audio_save_dir, exist_ok=True)
         os.makedirs(self.image_save_dir, exist_ok=True)
 
-        self.audio_filename_map: Dict[str, str] = {}
-        self.audio_bytes_map: Dict[str, int] = {}
+        # 保存中の音声ファイル（item_idごとに開いたままにし、audio.doneで閉じる。_wav_poolのスレッド専用）
+        self.audio_files: Dict[str, BinaryIO] = {}
+        self.audio_bytes_map: Dict[str, int] = defaultdict(int)
 
         self.openai_task: Optional[asyncio.Task] = None
-        self.cv2 = cv2
-        self.np = np
-        self.reference_image = None
+        # cv2/numpy は重いため、最初のクライアント接続時に遅延ロードする
+        self.cv2 = None
+        self.np = None
+        self.reference_image_hash: Optional[int] = None
         # server.pyと同じディレクトリにあると想定
         ref_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "empty_bin_reference.jpg")
+        self.reference_image_path: Optional[str] = None
         if os.path.exists(ref_path):
-            self.reference_image = cv2.imread(ref_path)
+            # 差分チェック用ハッシュはcv2のロード時にのみ計算する（通常はデコードしない）
+            self.reference_image_path = ref_path
+            # キャッシュ用のBase64作成（data URLとしてそのまま送信に使う）
+            self.reference_image_base64 = "data:image/jpeg;base64," + encode_file_base64(ref_path)
             LOGGER.info("Loaded reference image: %s", ref_path)
-            # キャッシュ用のBase64作成
-            with open(ref_path, "rb") as image_file:
-                 self.reference_image_base64 = "data:image/jpeg;base64," + base64.b64encode(image_file.read()).decode('utf-8')
         else:
             LOGGER.warning("Reference image not found: %s", ref_path)
             self.reference_image_base64 = None
 
+        # 画像判定リクエストの固定部分（基準画像ブロック）は一度だけ組み立てる
+        self.image_prefix_content: tuple = ()
+        if self.reference_image_base64:
+            self.image_prefix_content = (
+                {"type": "input_text", "text": "【基準画像：空のゴミ箱】"},
+                {"type": "input_image", "image_url": self.reference_image_base64},
+            )
+
         self.p = None
         self.stream = None
+        # Macスピーカー再生スレッドへ渡すキュー（stream.writeのブロッキングをループから切り離す）
+        self._playback_queue: Optional[queue.Queue] = None
+        self._playback_thread: Optional[threading.Thread] = None
 
         # 再接続カウンター
         self.reconnect_attempts = 0
@@ -379,8 +703,6 @@ class RelayHub:
                         stdin=subprocess.PIPE,
                         stdout=subprocess.PIPE,
                         stderr=subprocess.PIPE,
-                        text=True,
-                        bufsize=1,
                         **kwargs
                     )
                     LOGGER.info("Obniz bridge started: PID=%s", self.obniz_process.pid)
@@ -398,11 +720,12 @@ class RelayHub:
         """サブプロセスの出力をログに転送"""
         def log_output():
             try:
-                for line in iter(pipe.readline, ''):
-                    if line:
-                        LOGGER.info(f"[Obniz-{name}] {line.strip()}")
+                for line in iter(pipe.readline, b''):
+                    # 出力しないレベルのときはデコードもしない
+                    if line and LOGGER.isEnabledFor(logging.INFO):
+                        LOGGER.info("[Obniz-%s] %s", name, line.decode('utf-8', errors='replace').strip())
             except Exception as e:
-                LOGGER.error(f"Error reading Obniz {name}: {e}")
+                LOGGER.error("Error reading Obniz %s: %s", name, e)
             finally:
                 pipe.close()
 
@@ -418,8 +741,8 @@ class RelayHub:
         try:
             if not self.obniz_process or self.obniz_process.poll() is not None:
                 return False
-            command = json.dumps({"angle": angle}) + "\n"
-            self.obniz_process.stdin.write(command)
+            # バイナリモードのパイプへ組み立て済みのbytesを書き込む（テキストエンコード不要）
+            self.obniz_process.stdin.write(_servo_command(angle))
             self.obniz_process.stdin.flush()
             return True
         except Exception as e:
@@ -462,7 +785,7 @@ class RelayHub:
 
         # キューが他ループで作られていた場合は作り直す
         if self.to_openai is None or self.loop is None or self.loop is not current_loop:
-            self.to_openai = asyncio.Queue()
+            self.to_openai = OpenAISendQueue(OPENAI_QUEUE_MAXSIZE)
             self.loop = current_loop
 
         if self.openai_task and not self.openai_task.done():
@@ -470,31 +793,76 @@ class RelayHub:
         self.openai_task = asyncio.create_task(self._openai_loop())
 
     async def register_client(self, role: str, websocket: WebSocket):
+        send_queue: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_SEND_QUEUE_SIZE)
         async with self.lock:
+            old_writer = self.client_writers.pop(role, None)
             self.clients[role] = websocket
+            self.client_queues[role] = send_queue
+            self.client_writers[role] = asyncio.create_task(
+                self._client_writer(role, websocket, send_queue))
+        if old_writer:
+            old_writer.cancel()
         await self.ensure_openai_task()
 
-    async def unregister_client(self, role: str):
+    async def unregister_client(self, role: str, websocket: WebSocket):
         async with self.lock:
+            # 同じroleで再接続済みの場合は新しい接続を残す
+            if self.clients.get(role) is not websocket:
+                return
             self.clients.pop(role, None)
+            self.client_queues.pop(role, None)
+            writer = self.client_writers.pop(role, None)
+        if writer:
+            writer.cancel()
+
+    async def _client_writer(self, role: str, websocket: WebSocket, send_queue: asyncio.Queue):
+        """送信キューに溜まったメッセージを順に書き出す（遅いクライアントがリレーを止めないように分離）"""
+        try:
+            while True:
+                batch = [await send_queue.get()]
+                # 溜まっている分はまとめて取り出し、キューの起床回数を減らす
+                while not send_queue.empty() and len(batch) < CLIENT_SEND_BATCH_MAX:
+                    batch.append(send_queue.get_nowait())
+                for message in batch:
+                    await websocket.send_text(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            LOGGER.warning("Failed to send to role=%s: %s", role, e)
 
-    async def _safe_put_to_openai(self, event: dict) -> bool:
-        """OpenAI接続時のみキューに追加。未接続時はFalseを返す"""
+    def _enqueue(self, role: str, send_queue: asyncio.Queue, message: str):
+        """送信キューに追加（溢れた場合は破棄）"""
+        try:
+            send_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            LOGGER.warning("Send queue full for role=%s, dropping message", role)
+
+    async def _safe_put_to_openai(self, event: Union[dict, str, tuple]) -> bool:
+        """OpenAI接続時のみキューに追加。未接続時はFalseを返す
+
+        tupleで渡したイベント群は1要素としてキューに入り、同じ送信バッチで連続して送られる
+        strはシリアライズ済みのJSONとしてそのまま送信する
+        """
         if not self.openai_connected:
-            LOGGER.debug("OpenAI not connected, discarding event: %s", event.get("type"))
+            LOGGER.debug("OpenAI not connected, discarding event: %s", _event_type(event))
             return False
         if self.to_openai is None:
             return False
+        # 送信が詰まっている場合は古いマイク音声から捨てる（制御イベントは空きが出るまで待つ）
         await self.to_openai.put(event)
         return True
 
     async def handle_client(self, role: str, websocket: WebSocket):
-        # 遅延ロード
-        if self.cv2 is None or self.np is None:
+        # 遅延ロード（差分チェック無効時はcv2/numpy自体を読み込まない）
+        if ENABLE_DIFF_CHECK and (self.cv2 is None or self.np is None):
             import cv2  # type: ignore
             import numpy as np  # type: ignore
             self.cv2 = cv2
             self.np = np
+            if self.reference_image_path and self.reference_image_hash is None:
+                ref = cv2.imread(self.reference_image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+                if ref is not None:
+                    self.reference_image_hash = self._image_hash(ref)
 
         await websocket.accept()
         # ログ出力時にトークンを隠蔽
@@ -505,56 +873,74 @@ class RelayHub:
         await self.register_client(role, websocket)
 
         try:
+            # 受信ループ内で毎回引き直さないよう、よく使う属性はローカルに束縛しておく
+            loads = orjson.loads
+            put_to_openai = self._safe_put_to_openai
+            speaking_state = self.speaking_state
+            is_audio_source = role == self.audio_endpoint
+
+            # テキスト（JSONイベント）とバイナリ（JPEG）の両方を受けるため、receive()で直接受信する
             while True:
-                data = await websocket.receive_text()
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                data = message.get("text")
+                if data is None:
+                    # バイナリフレームはカメラからのJPEG生データ（Base64を経由しない画像送信）
+                    image_data = message.get("bytes")
+                    if image_data and role == "camera":
+                        processed = await self._process_image_bytes(image_data)
+                        if processed is not None:
+                            await put_to_openai((processed, _RESPONSE_CREATE_JSON))
+                    continue
 
                 # JSON パースを安全に行う
                 try:
-                    event = json.loads(data)
-                except json.JSONDecodeError as e:
+                    event = loads(data)
+                except orjson.JSONDecodeError as e:
                     LOGGER.warning("Invalid JSON from client (role=%s): %s", role, e)
                     continue
 
                 event_type = event.get("type")
 
                 if event_type == "input_audio_buffer.append":
-                    if role != self.audio_endpoint:
+                    if not is_audio_source:
                         continue
-                    if self.speaking_state.is_speaking:
+                    if speaking_state.is_speaking:
                         continue
-                    await self._safe_put_to_openai(event)
+                    await put_to_openai(event)
                     continue
 
                 if event_type == "conversation.item.create" and role == "camera":
-                    processed = await self._process_image_event(event)
+                    # 画像を含まないアイテムは書き換え不要なので、受信文字列の判定だけで走査を省く
+                    if '"input_image"' in data:
+                        processed = await self._process_image_event(event)
+                    else:
+                        processed = event
                     if processed is None:
                         continue
-                    await self._safe_put_to_openai(processed)
-                    # 画像を送った直後に必ずレスポンス生成をトリガーする
-                    await self._safe_put_to_openai({"type": "response.create"})
+                    # 画像を送った直後に必ずレスポンス生成をトリガーする（同じバッチで送信）
+                    await put_to_openai((processed, _RESPONSE_CREATE_JSON))
                     continue
 
                 if event_type == "response.create":
-                    async with self.session_state_lock:
-                        if self.session_state.get("skip_next_response"):
-                            self.session_state["skip_next_response"] = False
-                            continue
+                    if self.session_state.get("skip_next_response"):
+                        self.session_state["skip_next_response"] = False
+                        continue
 
-                await self._safe_put_to_openai(event)
+                # 書き換えないイベントは受信した文字列のまま転送する（再シリアライズしない）
+                await put_to_openai(data)
 
-        except WebSocketDisconnect:
             LOGGER.info("Client disconnected: role=%s", role)
         except Exception as e:
             LOGGER.error("Client handler error (role=%s): %s", role, e, exc_info=True)
         finally:
-            await self.unregister_client(role)
+            await self.unregister_client(role, websocket)
 
     async def _process_image_event(self, event: dict) -> Optional[dict]:
         try:
             content = event.get("item", {}).get("content", [])
-            new_content = []
             current_image_base64 = None
-            current_image_cv2 = None
             image_data = None
 
             for item in content:
@@ -569,99 +955,134 @@ class RelayHub:
                                          len(base64_data), MAX_BASE64_SIZE)
                             return None
 
-                        image_data = base64.b64decode(base64_data)
+                        # クライアントからの入力なので不正な文字は検証して弾く
+                        image_data = pybase64.b64decode(base64_data, validate=True)
                         current_image_base64 = image_url
 
-                        nparr = self.np.frombuffer(image_data, self.np.uint8)
-                        current_image_cv2 = self.cv2.imdecode(nparr, self.cv2.IMREAD_COLOR)
-
-            if current_image_cv2 is not None:
-                async with self.session_state_lock:
-                    prev_cv2 = self.session_state.get("previous_image_cv2")
-
-                # 差分チェックを削除し、常に判定を行う
-                # 背景差分チェック (empty_bin_reference.jpg との比較)
-                # 背景差分チェック (empty_bin_reference.jpg との比較)
-                # ユーザー要望により、OpenCVでの事前チェックを無効化し、いきなりAI判定へ進む
-                # if self.reference_image is not None:
-                #      if not self._is_image_changed(self.reference_image, current_image_cv2, threshold=IMAGE_DIFF_THRESHOLD):
-                #         LOGGER.info("Image matches reference (Empty Bin). Skipping AI processing.")
-                #         async with self.session_state_lock:
-                #              self.session_state["skip_next_response"] = True
-                #         return None
-                #      else:
-                #         LOGGER.info("Diff detected against reference. Proceeding.")
-
-                # 差分チェックを削除し、常に判定を行う
-                # if not self._is_image_changed(prev_cv2, current_image_cv2, threshold=IMAGE_DIFF_THRESHOLD):
-                #     LOGGER.info("Skipped sending image (No change detected)")
-                #     async with self.session_state_lock:
-                #         self.session_state["skip_next_response"] = True
-                #     return None
-
-                async with self.session_state_lock:
-                    self.session_state["previous_image_cv2"] = current_image_cv2
-
-                # 非同期でファイル保存（マイクロ秒付きで一意性を保証）
-                JST = timezone(timedelta(hours=9))
-                timestamp = datetime.datetime.now(JST).strftime("%Y%m%d_%H%M%S_%f")
-                filename = f"{timestamp}.jpg"
-                filepath = os.path.join(self.image_save_dir, filename)
-
-                loop = asyncio.get_running_loop()
-                await loop.run_in_executor(None, partial(self._save_file, filepath, image_data))
-                LOGGER.info("Image saved: %s", filepath)
-
-                async with self.session_state_lock:
-                    self.session_state["last_image_time"] = datetime.datetime.now().timestamp()
-
-            if current_image_base64:
-                # 単一画像のみを送信（Before/After比較は廃止）
-                # ユーザー要望により、基準画像（空のごみ箱）も送って比較させる
-                LOGGER.info("Sending current image for judgment")
-                
-                new_content = []
-                if self.reference_image_base64:
-                     new_content.append({"type": "input_text", "text": "【基準画像：空のゴミ箱】"})
-                     new_content.append({"type": "input_image", "image_url": self.reference_image_base64})
-                
-                new_content.append({"type": "input_text", "text": "【現在の画像】"})
-                new_content.append({"type": "input_image", "image_url": current_image_base64})
-                
-                # プロンプトを少し調整して、比較指示を含める
-                instruction_text = (
-                    "画像判定を行い、必ず log_disposal を呼び出してください。"
-                    "【注意】画像が送られてきた場合は、絶対に雑談だけで終わらせず、必ず log_disposal 関数を実行して判定結果を記録してください。"
-                    "【基準画像】と【現在の画像】を比較し、明らかに新しいゴミがない（空のまま）場合は、"
-                    "result='NG', rejection_reason='wrong_item' (空) と判定してください。"
-                )
-                new_content.append({"type": "input_text", "text": instruction_text})
-
-                # 前回の画像データ保持は不要だが、ロジック自体は残しても無害（今回は簡略化のため削除しても良いが、影響範囲最小化のため変数代入だけ残しておく）
-                async with self.session_state_lock:
-                    self.session_state["previous_image_data"] = current_image_base64
-                event["item"]["content"] = new_content
+            if image_data is None:
+                return event
+            return await self._attach_image(event, image_data, current_image_base64)
+        except Exception as e:
+            LOGGER.error("Image processing error: %s", e, exc_info=True)
+            return None
 
-            return event
+    async def _process_image_bytes(self, image_data: bytes) -> Optional[dict]:
+        """バイナリフレームで届いたJPEGから画像イベントを組み立てる（Base64デコードが不要）"""
+        if len(image_data) > MAX_IMAGE_BYTES:
+            LOGGER.warning("Image data too large: %d bytes (max: %d)", len(image_data), MAX_IMAGE_BYTES)
+            return None
+        try:
+            # OpenAIへはdata URLで渡す必要があるため、エンコードはここで1回だけ行う
+            image_url = "data:image/jpeg;base64," + pybase64.b64encode(image_data).decode("ascii")
+            event = {
+                "type": "conversation.item.create",
+                "item": {"type": "message", "role": "user", "content": []},
+            }
+            return await self._attach_image(event, image_data, image_url)
         except Exception as e:
             LOGGER.error("Image processing error: %s", e, exc_info=True)
             return None
 
+    async def _attach_image(self, event: dict, image_data: bytes, image_url: str) -> Optional[dict]:
+        """画像を保存し、判定用のコンテンツ（基準画像・指示文付き）にイベントを書き換える"""
+        current_image_hash = None
+        if ENABLE_DIFF_CHECK:
+            prev_hash = self.session_state.get("previous_image_hash")
+            # カメラ停止中などでバイト列が前回と完全一致する場合は、デコードせず前回のハッシュを使う
+            digest = hashlib.blake2b(image_data, digest_size=8).digest()
+            if prev_hash is not None and digest == self.session_state.get("previous_image_digest"):
+                current_image_hash = prev_hash
+            else:
+                # JPEGデコードとハッシュ計算はイベントループ外で実行
+                current_image_hash = await asyncio.get_running_loop().run_in_executor(
+                    _io_pool, self._decode_image_hash, image_data)
+            self.session_state["previous_image_digest"] = digest
+
+            # 差分チェックを削除し、常に判定を行う
+            # 背景差分チェック (empty_bin_reference.jpg との比較)
+            # 背景差分チェック (empty_bin_reference.jpg との比較)
+            # ユーザー要望により、OpenCVでの事前チェックを無効化し、いきなりAI判定へ進む
+            # if self.reference_image_hash is not None:
+            #      if not self._is_image_changed(self.reference_image_hash, current_image_hash):
+            #         LOGGER.info("Image matches reference (Empty Bin). Skipping AI processing.")
+            #         self.session_state["skip_next_response"] = True
+            #         return None
+            #      else:
+            #         LOGGER.info("Diff detected against reference. Proceeding.")
+
+            # 差分チェックを削除し、常に判定を行う
+            # if not self._is_image_changed(prev_hash, current_image_hash):
+            #     LOGGER.info("Skipped sending image (No change detected)")
+            #     self.session_state["skip_next_response"] = True
+            #     return None
+
+        if current_image_hash is not None:
+            self.session_state["previous_image_hash"] = current_image_hash
+
+        # 非同期でファイル保存（マイクロ秒付きで一意性を保証）
+        timestamp = datetime.datetime.now(JST).strftime("%Y%m%d_%H%M%S_%f")
+        filename = f"{timestamp}.jpg"
+        filepath = os.path.join(self.image_save_dir, filename)
+
+        # 保存はデバッグ用の控えなので完了を待たず、転送を先に進める
+        _io_pool.submit(self._save_file, filepath, image_data).add_done_callback(
+            partial(_log_background_error, "Image save"))
+
+        self.session_state["last_image_time"] = time.time()
+
+        # 単一画像のみを送信（Before/After比較は廃止）
+        # ユーザー要望により、基準画像（空のごみ箱）も送って比較させる
+        LOGGER.info("Sending current image for judgment")
+
+        event["item"]["content"] = [
+            *self.image_prefix_content,
+            _CURRENT_IMAGE_LABEL_ITEM,
+            {"type": "input_image", "image_url": image_url},
+            _IMAGE_INSTRUCTION_ITEM,
+        ]
+        return event
+
     def _save_file(self, filepath: str, data: bytes):
-        """同期的にファイルを保存（run_in_executor用）"""
-        with open(filepath, "wb") as f:
-            f.write(data)
+        """同期的にファイルを保存（_io_poolでの投げっぱなし実行用）
 
-    def _is_image_changed(self, img_prev, img_curr, threshold: float = IMAGE_DIFF_THRESHOLD) -> bool:
-        if img_prev is None:
+        一時ファイルに書き切ってから置き換えるため、/api/latest-image が書き込み途中のJPEGを返すことはない
+        """
+        tmp_path = filepath + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, filepath)
+            LOGGER.info("Image saved: %s", filepath)
+        except OSError as e:
+            LOGGER.error("Image save error: %s (%s)", filepath, e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _image_hash(self, gray) -> int:
+        """グレースケール画像から64ビットの平均ハッシュ(aHash)を計算"""
+        small = self.cv2.resize(gray, (IMAGE_HASH_SIZE, IMAGE_HASH_SIZE),
+                                interpolation=self.cv2.INTER_AREA)
+        bits = small > small.mean()
+        return int.from_bytes(self.np.packbits(bits).tobytes(), "big")
+
+    def _decode_image_hash(self, image_data: bytes) -> Optional[int]:
+        """JPEGを1/8縮小グレースケールでデコードしてハッシュ化（同期、run_in_executor用）"""
+        nparr = self.np.frombuffer(image_data, self.np.uint8)
+        gray = self.cv2.imdecode(nparr, self.cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if gray is None:
+            return None
+        return self._image_hash(gray)
+
+    def _is_image_changed(self, hash_prev: Optional[int], hash_curr: int,
+                          threshold: int = IMAGE_HASH_DISTANCE_THRESHOLD) -> bool:
+        if hash_prev is None:
             return True
-        img_prev_small = self.cv2.resize(img_prev, IMAGE_RESIZE_SIZE)
-        img_curr_small = self.cv2.resize(img_curr, IMAGE_RESIZE_SIZE)
-        diff = self.cv2.absdiff(img_prev_small, img_curr_small)
-        diff_gray = self.cv2.cvtColor(diff, self.cv2.COLOR_BGR2GRAY)
-        mean_diff = self.np.mean(diff_gray)
-        LOGGER.info("Image diff: %.2f", mean_diff)
-        return mean_diff > threshold
+        # 異なるビット数（ハミング距離）で比較
+        distance = bin(hash_prev ^ hash_curr).count("1")
+        LOGGER.info("Image hash distance: %d", distance)
+        return distance > threshold
 
     async def _openai_loop(self):
         headers = {
@@ -671,7 +1092,9 @@ class RelayHub:
 
         while True:
             try:
-                async with connect(URL, additional_headers=headers) as openai_ws:
+                # 音声base64は圧縮が効かずCPUだけ消費するためpermessage-deflateは無効
+                async with connect(URL, additional_headers=headers, compression=None,
+                                   ssl=OPENAI_SSL_CONTEXT) as openai_ws:
                     LOGGER.info("Connected to OpenAI Realtime API")
                     self.reconnect_attempts = 0  # 接続成功でリセット
                     self.openai_connected = True  # 接続状態フラグをTrue
@@ -687,6 +1110,7 @@ class RelayHub:
                                 rate=AUDIO_SAMPLE_RATE,
                                 output=True
                             )
+                            self._start_playback_thread()
                             LOGGER.info("Mac speaker output: ON")
                         except Exception as e:
                             LOGGER.error("Failed to initialize audio output: %s", e, exc_info=True)
@@ -708,6 +1132,8 @@ class RelayHub:
                             await receiver
                         except asyncio.CancelledError:
                             pass
+                        # audio.doneを受け取れなかった音声ファイルのヘッダーを確定
+                        await self._finalize_all_audio()
 
             except Exception as e:
                 LOGGER.error("OpenAI loop error: %s", e, exc_info=True)
@@ -740,28 +1166,38 @@ class RelayHub:
                 await asyncio.sleep(delay)
 
             finally:
-                if self.stream:
-                    try:
-                        self.stream.stop_stream()
-                        self.stream.close()
-                    except Exception:
-                        pass
-                    self.stream = None
-                if self.p:
-                    try:
-                        self.p.terminate()
-                    except Exception:
-                        pass
-                    self.p = None
+                handed_off = self._stop_playback_thread()
+                stream, p = self.stream, self.p
+                self.stream = None
+                self.p = None
+                if not handed_off:
+                    # 再生スレッドがない（または既に終了した）場合だけここで解放する
+                    self._close_audio_output(stream, p)
                 LOGGER.info("OpenAI connection closed")
 
     async def _pump_to_openai(self, openai_ws):
+        send = openai_ws.send
+        dumps = orjson.dumps
         while True:
             if self.to_openai is None:
                 await asyncio.sleep(0.01)
                 continue
-            event = await self.to_openai.get()
-            await openai_ws.send(json.dumps(event))
+            items = [await self.to_openai.get()]
+            # 溜まっているイベントをまとめて取り出す
+            while len(items) < OPENAI_SEND_BATCH_MAX:
+                try:
+                    items.append(self.to_openai.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            batch = []
+            for item in items:
+                if isinstance(item, tuple):
+                    batch.extend(item)
+                else:
+                    batch.append(item)
+            for event in _coalesce_audio_appends(batch):
+                # Realtime APIはテキストフレームのJSONを前提とするためstrで送る
+                await send(event if isinstance(event, str) else dumps(event).decode())
 
     async def _pump_from_openai(self, openai_ws):
         important_events = {
@@ -777,189 +1213,307 @@ class RelayHub:
             "response.output_item.done",
             "conversation.item.created",
         }
+        # イベント種別→処理のテーブル（音声deltaなど高頻度イベントでif連鎖を辿らず1回の参照で分岐）
+        handlers = {
+            "response.function_call_arguments.done": self._on_function_call,
+            "response.audio_transcript.delta": self._on_transcript,
+            "response.audio_transcript.done": self._on_transcript,
+            "response.output_text.delta": self._on_output_text,
+            "response.output_text.done": self._on_output_text,
+            "response.audio.start": self._on_audio_start,
+            "response.output_audio.start": self._on_audio_start,
+            "response.audio.delta": self._on_audio_delta,
+            "response.audio.done": self._on_audio_done,
+            "response.completed": self._on_audio_done,
+            "response.done": self._on_audio_done,
+        }
+        loads = orjson.loads
+        get_handler = handlers.get
+        broadcast = self._broadcast
         async for message in openai_ws:
-            event = json.loads(message)
+            event = loads(message)
             event_type = event.get("type")
 
             if event_type in important_events:
                 LOGGER.info("event: %s item=%s", event_type, event.get("item_id"))
 
-            if event_type == "response.function_call_arguments.done":
-                await handle_function_call(event, openai_ws, self.session_state, self.session_state_lock)
-                await self._broadcast(message)
-                continue
-
-            if event_type.startswith("response.audio_transcript"):
-                item_id = event.get("item_id")
-                transcript_text = event.get("transcript") or event.get("delta") or ""
-                async with self.session_state_lock:
-                    if item_id:
-                        tm = self.session_state.get("transcript_map", {})
-                        if event_type.endswith(".done") and transcript_text:
-                            tm[item_id] = transcript_text
-                        else:
-                            tm[item_id] = tm.get(item_id, "") + transcript_text
-                        self.session_state["transcript_map"] = tm
-                        if transcript_text:
-                            self.session_state["last_transcript_info"] = {
-                                "text": tm[item_id],
-                                "time": datetime.datetime.now().timestamp(),
-                            }
-                    elif transcript_text:
-                        self.session_state["last_transcript_info"] = {
-                            "text": transcript_text,
-                            "time": datetime.datetime.now().timestamp(),
-                        }
-                if event_type.endswith(".done") and transcript_text:
-                    LOGGER.info("transcript %s item=%s text=\"%s\"",
-                               event_type, item_id, transcript_text.replace("\n", "\\n")[:200])
-                    
-                    # 直近の廃棄ログがあれば、トランスクリプトでメッセージを更新
-                    async with self.session_state_lock:
-                        last_ts = self.session_state.get("last_disposal_timestamp")
-                        # タイムスタンプがあり、かつトランスクリプトが空でない場合
-                        if last_ts and transcript_text:
-                            # 簡易的な紐付け: 直近のログを更新する（厳密にはitem_idで紐付けるのがベストだが、Function Call直後の発話とみなす）
-                            # 念のため、ログ記録から時間が経ちすぎていないかチェック（例: 10秒以内）
-                            try:
-                                JST = timezone(timedelta(hours=9))
-                                log_dt = datetime.datetime.fromisoformat(last_ts)
-                                if (datetime.datetime.now(JST) - log_dt).total_seconds() < 10:
-                                    # 非同期でDB更新を実行
-                                    loop = asyncio.get_running_loop()
-                                    await loop.run_in_executor(None, db.update_record_message, "webapp_user", last_ts, transcript_text)
-                                    LOGGER.info("Updated DB record %s with transcript", last_ts)
-                                    # 一度更新したらクリア（二重更新防止）
-                                    self.session_state["last_disposal_timestamp"] = None
-                            except Exception as e:
-                                LOGGER.warning("Failed to update DB with transcript: %s", e)
-
-                await self._broadcast(message)
-                continue
-
-            if event_type.startswith("response.output_text"):
-                if event_type.endswith(".done"):
-                    text_delta = event.get("text") or event.get("delta") or ""
-                    LOGGER.info("%s item=%s text=\"%s\"",
-                               event_type, event.get("item_id"), str(text_delta).replace("\n", "\\n")[:200])
-                await self._broadcast(message)
-                continue
-
-            # 発話開始
-            if event_type in ("response.audio.start", "response.output_audio.start"):
-                LOGGER.info("audio.start item=%s", event.get("item_id"))
-                await self.speaking_state.start_speaking()
-                await self._broadcast(message)
-                continue
-
-            if event_type == "response.audio.delta":
-                await self.speaking_state.start_speaking()
-                await self._handle_audio_delta(event, message)
-                continue
-
-            # 発話終了
-            if event_type in ("response.audio.done", "response.completed", "response.done"):
-                await self.speaking_state.stop_speaking()
-                item_id = event.get("item_id")
-                total_bytes = self.audio_bytes_map.pop(item_id, 0) if item_id else 0
-                LOGGER.info("audio.done item=%s total_bytes=%d", item_id, total_bytes)
-                
-                # 予約されたサーボ動作があれば実行
-                async with self.session_state_lock:
-                    pending_angle = self.session_state.get("pending_servo_angle")
-                    self.session_state["pending_servo_angle"] = None
-                
-                if pending_angle is not None:
-                     LOGGER.info("Executing pending servo action: %d degrees", pending_angle)
-                     await self.control_servo(pending_angle)
-
-                await self._broadcast(message)
-                continue
-
-            await self._broadcast(message)
+            handler = get_handler(event_type)
+            if handler is None:
+                # 表にない派生イベントは従来どおり接頭辞で振り分ける
+                if event_type.startswith("response.audio_transcript"):
+                    handler = self._on_transcript
+                elif event_type.startswith("response.output_text"):
+                    handler = self._on_output_text
+                else:
+                    await broadcast(message)
+                    continue
+            await handler(event_type, event, message, openai_ws)
+
+    async def _on_function_call(self, event_type: str, event: dict, message: str, openai_ws):
+        await handle_function_call(event, openai_ws, self.session_state)
+        await self._broadcast(message)
+
+    async def _on_transcript(self, event_type: str, event: dict, message: str, openai_ws):
+        item_id = event.get("item_id")
+        transcript_text = event.get("transcript") or event.get("delta") or ""
+        if item_id:
+            tm = self.session_state.get("transcript_map", {})
+            if event_type.endswith(".done") and transcript_text:
+                tm[item_id] = transcript_text
+            else:
+                tm[item_id] = tm.get(item_id, "") + transcript_text
+            self.session_state["transcript_map"] = tm
+            if transcript_text:
+                self.session_state["last_transcript_info"] = {
+                    "text": tm[item_id],
+                    "time": time.time(),
+                }
+        elif transcript_text:
+            self.session_state["last_transcript_info"] = {
+                "text": transcript_text,
+                "time": time.time(),
+            }
+        if event_type.endswith(".done") and transcript_text:
+            if LOGGER.isEnabledFor(logging.INFO):
+                LOGGER.info("transcript %s item=%s text=\"%s\"",
+                           event_type, item_id, transcript_text.replace("\n", "\\n")[:200])
+            
+            # 直近の廃棄ログがあれば、トランスクリプトでメッセージを更新
+            last_ts = self.session_state.get("last_disposal_timestamp")
+            # タイムスタンプがあり、かつトランスクリプトが空でない場合
+            if last_ts and transcript_text:
+                # 簡易的な紐付け: 直近のログを更新する（厳密にはitem_idで紐付けるのがベストだが、Function Call直後の発話とみなす）
+                # 念のため、ログ記録から時間が経ちすぎていないかチェック（例: 10秒以内）
+                try:
+                    log_dt = datetime.datetime.fromisoformat(last_ts)
+                    if (datetime.datetime.now(JST) - log_dt).total_seconds() < 10:
+                        # 非同期でDB更新を実行（挿入と同じ_db_poolに積み、先行する記録の後に走らせる）
+                        loop = asyncio.get_running_loop()
+                        await loop.run_in_executor(_db_pool, db.update_record_message, "webapp_user", last_ts, transcript_text)
+                        LOGGER.info("Updated DB record %s with transcript", last_ts)
+                        # 一度更新したらクリア（二重更新防止）
+                        self.session_state["last_disposal_timestamp"] = None
+                except Exception as e:
+                    LOGGER.warning("Failed to update DB with transcript: %s", e)
+
+        await self._broadcast(message)
+
+    async def _on_output_text(self, event_type: str, event: dict, message: str, openai_ws):
+        if event_type.endswith(".done") and LOGGER.isEnabledFor(logging.INFO):
+            text_delta = event.get("text") or event.get("delta") or ""
+            LOGGER.info("%s item=%s text=\"%s\"",
+                       event_type, event.get("item_id"), str(text_delta).replace("\n", "\\n")[:200])
+        await self._broadcast(message)
+
+    async def _on_audio_start(self, event_type: str, event: dict, message: str, openai_ws):
+        # 発話開始
+        LOGGER.info("audio.start item=%s", event.get("item_id"))
+        await self.speaking_state.start_speaking()
+        await self._broadcast(message)
+
+    async def _on_audio_delta(self, event_type: str, event: dict, message: str, openai_ws):
+        await self.speaking_state.start_speaking()
+        await self._handle_audio_delta(event, message)
+
+    async def _on_audio_done(self, event_type: str, event: dict, message: str, openai_ws):
+        # 発話終了
+        await self.speaking_state.stop_speaking()
+        item_id = event.get("item_id")
+        # deltaと同じくサニタイズ済みのIDで集計・保存しているため、同じ変換をしてから参照する
+        saved_id = sanitize_item_id(item_id) if item_id else None
+        total_bytes = self.audio_bytes_map.pop(saved_id, 0) if saved_id else 0
+        LOGGER.info("audio.done item=%s total_bytes=%d", item_id, total_bytes)
+        if saved_id:
+            await self._finalize_audio(saved_id)
+        
+        # 予約されたサーボ動作があれば実行
+        pending_angle = self.session_state.get("pending_servo_angle")
+        self.session_state["pending_servo_angle"] = None
+        
+        if pending_angle is not None:
+             LOGGER.info("Executing pending servo action: %d degrees", pending_angle)
+             await self.control_servo(pending_angle)
+
+        await self._broadcast(message)
 
     async def _handle_audio_delta(self, event: dict, raw_message: str):
         base64_audio = event.get("delta", "")
         if base64_audio:
-            audio_data = base64.b64decode(base64_audio)
             item_id = sanitize_item_id(event.get("item_id", "unknown"))
+            playback_queue = self._playback_queue
+            play_local = playback_queue is not None
+
+            if not (SAVE_AUDIO or play_local):
+                # 転送するだけなのでデコードせず、パディングからバイト数を求める
+                decoded_len = len(base64_audio) // 4 * 3 - base64_audio[-2:].count("=")
+                self.audio_bytes_map[item_id] += decoded_len
+                await self._send_to_role(self.audio_endpoint, raw_message)
+                return
 
-            # 非同期でファイル保存
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(None, partial(self._save_audio_chunk, item_id, audio_data))
+            if SAVE_AUDIO:
+                # デコードとファイル保存をまとめてWAV専用スレッドで実行
+                loop = asyncio.get_running_loop()
+                audio_data = await loop.run_in_executor(
+                    _wav_pool, self._decode_and_save_audio_chunk, item_id, base64_audio)
+            else:
+                audio_data = pybase64.b64decode(base64_audio, validate=False)
 
-            self.audio_bytes_map[item_id] = self.audio_bytes_map.get(item_id, 0) + len(audio_data)
+            self.audio_bytes_map[item_id] += len(audio_data)
 
-            if self.use_mac_speaker and self.stream:
-                await loop.run_in_executor(None, self.stream.write, audio_data)
+            if play_local:
+                try:
+                    playback_queue.put_nowait(audio_data)
+                except queue.Full:
+                    LOGGER.warning("Playback queue full, dropping audio chunk (item_id=%s)", item_id)
                 return
 
         await self._send_to_role(self.audio_endpoint, raw_message)
 
+    @staticmethod
+    def _close_audio_output(stream, p):
+        """PyAudioのストリームと本体を解放する（同期）"""
+        if stream:
+            try:
+                stream.stop_stream()
+                stream.close()
+            except Exception:
+                pass
+        if p:
+            try:
+                p.terminate()
+            except Exception:
+                pass
+
+    def _start_playback_thread(self):
+        playback_queue: queue.Queue = queue.Queue(maxsize=AUDIO_PLAYBACK_QUEUE_SIZE)
+        stream, p = self.stream, self.p
+
+        def playback_loop():
+            _pin_io_thread()
+            try:
+                play_until_sentinel()
+            finally:
+                # ストリームは書き込み中の他スレッドから閉じられないよう、このスレッド自身が解放する
+                self._close_audio_output(stream, p)
+
+        def play_until_sentinel():
+            running = True
+            while running:
+                chunk = playback_queue.get()
+                if chunk is None:
+                    break
+                # 溜まっているdeltaはまとめて1回のwriteで書き込む（書き込み回数を減らす）
+                chunks = [chunk]
+                size = len(chunk)
+                while size < AUDIO_PLAYBACK_WRITE_MAX:
+                    try:
+                        chunk = playback_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if chunk is None:
+                        running = False
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+                try:
+                    stream.write(chunks[0] if len(chunks) == 1 else b"".join(chunks))
+                except Exception as e:
+                    LOGGER.error("Audio playback error: %s", e)
+                    break
+
+        self._playback_queue = playback_queue
+        self._playback_thread = threading.Thread(target=playback_loop, name="audio-out", daemon=True)
+        self._playback_thread.start()
+
+    def _stop_playback_thread(self) -> bool:
+        """再生スレッドに終了を合図する（終了は待たない）
+
+        Returns: 再生スレッドが動いていてストリームの解放を引き受けた場合True
+        """
+        playback_queue, thread = self._playback_queue, self._playback_thread
+        self._playback_queue = None
+        self._playback_thread = None
+        if playback_queue is None:
+            return False
+        # 未再生分は破棄して終了の合図を送る（joinするとイベントループが止まるため待たない）
+        while True:
+            try:
+                playback_queue.get_nowait()
+            except queue.Empty:
+                break
+        playback_queue.put_nowait(None)
+        return thread is not None and thread.is_alive()
+
+    def _decode_and_save_audio_chunk(self, item_id: str, base64_audio: str) -> bytes:
+        """base64をデコードして保存し、デコード済みのPCMを返す（同期、run_in_executor用）"""
+        audio_data = pybase64.b64decode(base64_audio, validate=False)
+        self._save_audio_chunk(item_id, audio_data)
+        return audio_data
+
     def _save_audio_chunk(self, item_id: str, audio_data: bytes):
-        """音声チャンクを保存（同期、run_in_executor用）"""
-        if item_id not in self.audio_filename_map:
+        """音声チャンクを追記保存（同期、run_in_executor用）"""
+        f = self.audio_files.get(item_id)
+        if f is None:
             timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.audio_filename_map[item_id] = f"{timestamp}_{item_id}.wav"
-
-        filename = self.audio_filename_map[item_id]
-        filepath = os.path.join(self.audio_save_dir, filename)
-        new_file = not os.path.exists(filepath)
-        mode = "r+b" if not new_file else "wb"
-
-        with open(filepath, mode) as f:
-            if mode == "wb":
-                f.write(b"RIFF")
-                f.write(b"\x00\x00\x00\x00")
-                f.write(b"WAVE")
-                f.write(b"fmt ")
-                f.write(struct.pack("<IHHIIHH", 16, 1, AUDIO_CHANNELS,
-                                   AUDIO_SAMPLE_RATE, AUDIO_BYTE_RATE,
-                                   AUDIO_CHANNELS * AUDIO_BITS_PER_SAMPLE // 8,
-                                   AUDIO_BITS_PER_SAMPLE))
-                f.write(b"data")
-                f.write(b"\x00\x00\x00\x00")
-                f.write(audio_data)
-            else:
-                f.seek(0, 2)
-                f.write(audio_data)
+            filepath = os.path.join(self.audio_save_dir, f"{timestamp}_{item_id}.wav")
+            # ファイルは応答の間開いたままにし、チャンクごとのopen/closeを避ける
+            f = open(filepath, "wb")
+            f.write(_WAV_HEADER_TEMPLATE)
+            self.audio_files[item_id] = f
+            LOGGER.info("Audio saved: %s (item_id=%s)", filepath, item_id)
 
-            file_size = f.tell()
+        # ヘッダーのサイズ欄は _finalize_wav でまとめて書き込むため、ここでは追記のみ
+        f.write(audio_data)
+
+    @staticmethod
+    def _finalize_wav(f: BinaryIO):
+        """WAVヘッダーのRIFF/dataサイズを確定してファイルを閉じる（同期、run_in_executor用）"""
+        try:
+            file_size = f.seek(0, os.SEEK_END)
             f.seek(4)
-            f.write(struct.pack("<I", file_size - 8))
+            f.write(_UINT32_LE.pack(file_size - 8))
             f.seek(40)
-            f.write(struct.pack("<I", file_size - 44))
+            f.write(_UINT32_LE.pack(file_size - 44))
+        finally:
+            f.close()
 
-        if new_file:
-            LOGGER.info("Audio saved: %s (item_id=%s)", filepath, item_id)
+    def _finalize_audio_file(self, item_id: str):
+        """item_idのWAVを確定する（同期、_wav_pool用）"""
+        f = self.audio_files.pop(item_id, None)
+        if f is None:
+            return
+        try:
+            self._finalize_wav(f)
+        except (OSError, ValueError) as e:
+            LOGGER.error("Failed to finalize audio %s: %s", f.name, e)
 
-    async def _broadcast(self, message: str):
-        """全クライアントにメッセージを並列送信"""
-        async with self.lock:
-            targets = list(self.clients.values())
+    def _finalize_all_audio_files(self):
+        """開いている全WAVを確定する（同期、_wav_pool用）"""
+        for item_id in list(self.audio_files):
+            self._finalize_audio_file(item_id)
 
-        if not targets:
-            return
+    # キャンセルされた受信処理のチャンク書き込みが残っていても、_wav_poolは投入順に実行するため確定は必ずその後になる
+    async def _finalize_audio(self, item_id: str):
+        await asyncio.get_running_loop().run_in_executor(_wav_pool, self._finalize_audio_file, item_id)
 
-        # 並列送信
-        async def safe_send(ws: WebSocket):
-            try:
-                await ws.send_text(message)
-            except Exception as e:
-                LOGGER.warning("Failed to broadcast to client: %s", e)
+    async def _finalize_all_audio(self):
+        await asyncio.get_running_loop().run_in_executor(_wav_pool, self._finalize_all_audio_files)
 
-        await asyncio.gather(*[safe_send(ws) for ws in targets], return_exceptions=True)
+    async def _broadcast(self, message: str):
+        """全クライアントの送信キューにメッセージを追加"""
+        async with self.lock:
+            targets = list(self.client_queues.items())
+
+        for role, send_queue in targets:
+            self._enqueue(role, send_queue, message)
 
     async def _send_to_role(self, role: str, message: str):
         async with self.lock:
-            ws = self.clients.get(role)
-        if ws is None:
+            send_queue = self.client_queues.get(role)
+        if send_queue is None:
             LOGGER.info("No client for role=%s to send audio", role)
             return
-        try:
-            await ws.send_text(message)
-        except Exception as e:
-            LOGGER.warning("Failed to send to role=%s: %s", role, e)
+        self._enqueue(role, send_queue, message)
 
     def cleanup(self):
         """終了時のクリーンアップ"""
@@ -1020,8 +1574,9 @@ async def websocket_endpoint(websocket: WebSocket):
     await hub.handle_client(role, websocket)
 
 
-async def init_session(ws):
-    """セッション設定を送信"""
+@lru_cache(maxsize=1)
+def _session_update_json() -> str:
+    """session.update イベントのJSON（内容は起動後不変のため初回に一度だけ生成）"""
     event = {
         "type": "session.update",
         "session": {
@@ -1159,11 +1714,49 @@ async def init_session(ws):
             "tool_choice": "auto",
         },
     }
-    await ws.send(json.dumps(event))
+    return orjson.dumps(event).decode()
+
+
+async def init_session(ws):
+    """セッション設定を送信"""
+    await ws.send(_session_update_json())
     LOGGER.info("Session configuration sent")
 
 
-async def handle_function_call(event, ws, session_state: dict, session_state_lock: asyncio.Lock):
+# 判定結果の読み上げ指示（NG/OK時の振る舞い）
+_SPEAK_REACTION_INSTRUCTION = (
+    "NGの場合: 本気で怒ってください。「アカン！」「何してんねん！」など強い口調で叱り、"
+    "理由を短く1文で伝えてください。"
+    "OKの場合: テンションMAXで褒めちぎってください。「最高や！」「完璧やで！」など、"
+    "喜びを1文で爆発させてください。"
+)
+_SPEAK_RESULT_ONLY_JSON = orjson.dumps({
+    "type": "response.create",
+    "response": {
+        "modalities": ["audio", "text"],
+        "instructions": "ユーザーに最終的な判定結果だけを短く感情たっぷりに伝えてください。" + _SPEAK_REACTION_INSTRUCTION,
+    }
+}).decode()
+
+
+def _forget_disposal_timestamp(session_state: dict, timestamp_iso: str):
+    """書き込まれなかったレコードをトランスクリプト更新の対象から外す（イベントループ上で実行）"""
+    if session_state.get("last_disposal_timestamp") == timestamp_iso:
+        session_state["last_disposal_timestamp"] = None
+
+
+def _on_record_inserted(loop: asyncio.AbstractEventLoop, session_state: dict, timestamp_iso: str, future):
+    """DB挿入の完了通知（_db_poolのスレッドで呼ばれる）"""
+    error = future.exception()
+    if error is not None:
+        # 完了を待たずに投げているため、ここで記録しないと失敗に気付けない
+        LOGGER.error("DB insert failed (timestamp=%s): %s", timestamp_iso, error, exc_info=error)
+    if error is not None or not future.result():
+        # 例外・重複スキップ・保存エラーで書かれなかった場合
+        loop.call_soon_threadsafe(_forget_disposal_timestamp, session_state, timestamp_iso)
+
+
+async def handle_function_call(event, ws, session_state: dict):
     """Function Calling の処理"""
     call_id = event.get("call_id")
     name = event.get("name")
@@ -1175,19 +1768,18 @@ async def handle_function_call(event, ws, session_state: dict, session_state_loc
         try:
             # 冪等性チェック
             idempotency_key = generate_idempotency_key(call_id, args_str)
-            async with session_state_lock:
-                processed_ids: OrderedDict = session_state.get("processed_call_ids", OrderedDict())
-                if idempotency_key in processed_ids:
-                    LOGGER.info("Duplicate function call detected, skipping: %s", idempotency_key)
-                    return
-                processed_ids[idempotency_key] = True
-                # 古いキーを先頭から削除（最大100件保持、FIFO順）
-                while len(processed_ids) > 100:
-                    processed_ids.popitem(last=False)
-                session_state["processed_call_ids"] = processed_ids
-
-                last_image_time = session_state.get("last_image_time", 0)
-                last_judgment_time = session_state.get("last_judgment_time", 0)
+            processed_ids: Dict[int, bool] = session_state.get("processed_call_ids", {})
+            if idempotency_key in processed_ids:
+                LOGGER.info("Duplicate function call detected, skipping: %016x", idempotency_key)
+                return
+            processed_ids[idempotency_key] = True
+            # 古いキーを先頭から削除（最大100件保持、FIFO順）
+            while len(processed_ids) > 100:
+                processed_ids.pop(next(iter(processed_ids)))
+            session_state["processed_call_ids"] = processed_ids
+
+            last_image_time = session_state.get("last_image_time", 0)
+            last_judgment_time = session_state.get("last_judgment_time", 0)
 
             image_pending = last_image_time > last_judgment_time
 
@@ -1209,25 +1801,25 @@ async def handle_function_call(event, ws, session_state: dict, session_state_loc
             cleaned_args = cleaned_args.replace(";}", "}")
 
             try:
-                args = json.loads(cleaned_args)
-            except json.JSONDecodeError:
+                args = orjson.loads(cleaned_args)
+            except orjson.JSONDecodeError:
                 LOGGER.error("Failed to parse JSON: '%s'", cleaned_args)
                 raise
-            has_change = args.get("has_change", False)
-            if not image_pending:
-                has_change = False
+            # 未判定の画像がなければ変化なし扱い（引数は見ない）
+            has_change = image_pending and args.get("has_change", False)
 
             # messageは元の引数を基本としつつ、最新トランスクリプトが直近の画像後にある場合は上書き
+            # （画像時刻は冪等性チェック時に読んだ値を使い回す）
             message_val = args.get("message")
-            async with session_state_lock:
-                lt = session_state.get("last_transcript_info")
-                if lt and lt.get("time", 0) >= session_state.get("last_image_time", 0):
-                    message_val = lt.get("text", message_val)
+            lt = session_state.get("last_transcript_info")
+            if lt and lt.get("time", 0) >= last_image_time:
+                message_val = lt.get("text", message_val)
 
             # DB保存
             image_path = "webapp_session" if image_pending else "webapp_chat"
-            JST = timezone(timedelta(hours=9))
-            timestamp_iso = datetime.datetime.now(JST).isoformat()
+            # 判定時刻は1回だけ取得し、DB用ISO文字列と数値の両方に使う
+            judged_at = time.time()
+            timestamp_iso = datetime.datetime.fromtimestamp(judged_at, JST).isoformat()
 
             result_json = {
                 "detected_items": [args.get("items")],
@@ -1237,9 +1829,8 @@ async def handle_function_call(event, ws, session_state: dict, session_state_loc
                 "message": message_val
             }
 
-            # DB保存（非同期化してブロッキングを回避）
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(None, partial(
+            # DB保存は_db_poolに投げて完了を待たない（function_call_outputと発話指示を先に返す）
+            future = _db_pool.submit(partial(
                 db.insert_record,
                 image_path=image_path,
                 result_json=result_json,
@@ -1247,14 +1838,15 @@ async def handle_function_call(event, ws, session_state: dict, session_state_loc
                 rejection_reason=args.get("rejection_reason"),
                 timestamp=timestamp_iso
             ))
+            future.add_done_callback(partial(
+                _on_record_inserted, asyncio.get_running_loop(), session_state, timestamp_iso))
 
             # 判定時刻を更新 & ログ用タイムスタンプを保存
-            async with session_state_lock:
-                session_state["last_judgment_time"] = datetime.datetime.now().timestamp()
-                session_state["last_transcript_info"] = None
-                session_state["last_tool_time"] = datetime.datetime.now().timestamp()
-                # DBに保存したタイムスタンプを記録（トランスクリプト更新用）
-                session_state["last_disposal_timestamp"] = timestamp_iso
+            session_state["last_judgment_time"] = judged_at
+            session_state["last_transcript_info"] = None
+            session_state["last_tool_time"] = judged_at
+            # DBに保存したタイムスタンプを記録（トランスクリプト更新用）
+            session_state["last_disposal_timestamp"] = timestamp_iso
 
             log_data = {
                 "items": args.get("items"),
@@ -1263,25 +1855,19 @@ async def handle_function_call(event, ws, session_state: dict, session_state_loc
                 "has_change": has_change,
                 "message": message_val
             }
-            LOGGER.info("Judgment Result: %s", json.dumps(log_data, ensure_ascii=False))
-            LOGGER.info("DB saved image_path=%s user_id=%s", image_path, "webapp_user")
+            if LOGGER.isEnabledFor(logging.INFO):
+                LOGGER.info("Judgment Result: %s", orjson.dumps(log_data).decode())
+            LOGGER.info("DB save queued image_path=%s user_id=%s", image_path, "webapp_user")
 
             # Obnizサーボ制御
             # 異物(wrong_item)でない場合、アクションを予約する（発話完了後に実行するため）
             if log_data["rejection_reason"] != "wrong_item":
                 target_angle = 45 if log_data["result"] == "OK" else 135
-                async with session_state_lock:
-                    session_state["pending_servo_angle"] = target_angle
+                session_state["pending_servo_angle"] = target_angle
                 LOGGER.info("Servo action scheduled: %d degrees (waiting for audio.done)", target_angle)
             else:
                 LOGGER.info("Ignored servo control (wrong_item)")
 
-            # 判定時刻を更新
-            async with session_state_lock:
-                session_state["last_judgment_time"] = datetime.datetime.now().timestamp()
-                session_state["last_transcript_info"] = None
-                session_state["last_tool_time"] = datetime.datetime.now().timestamp()
-
             output_event = {
                 "type": "conversation.item.create",
                 "item": {
@@ -1290,42 +1876,43 @@ async def handle_function_call(event, ws, session_state: dict, session_state_loc
                     "output": "Successfully logged.",
                 },
             }
-            await ws.send(json.dumps(output_event))
+            await ws.send(orjson.dumps(output_event).decode())
 
             # 異物(wrong_item)の場合は沈黙させる
             if log_data["rejection_reason"] == "wrong_item":
                 LOGGER.info("Silence enforced (wrong_item)")
             else:
-                speak_instruction = (
-                    f"以下のメッセージを感情を込めて読み上げてください: {message_val}\n"
-                    "NGの場合: 本気で怒ってください。「アカン！」「何してんねん！」など強い口調で叱り、"
-                    "理由を短く1文で伝えてください。"
-                    "OKの場合: テンションMAXで褒めちぎってください。「最高や！」「完璧やで！」など、"
-                    "喜びを1文で爆発させてください。"
-                )
-                if not message_val:
-                    speak_instruction = (
-                        "ユーザーに最終的な判定結果だけを短く感情たっぷりに伝えてください。"
-                        "NGの場合: 本気で怒ってください。「アカン！」「何してんねん！」など強い口調で叱り、"
-                        "理由を短く1文で伝えてください。"
-                        "OKの場合: テンションMAXで褒めちぎってください。「最高や！」「完璧やで！」など、"
-                        "喜びを1文で爆発させてください。"
-                    )
-
-                speak_event = {
-                    "type": "response.create",
-                    "response": {
-                        "modalities": ["audio", "text"],
-                        "instructions": speak_instruction
+                if message_val:
+                    speak_event = {
+                        "type": "response.create",
+                        "response": {
+                            "modalities": ["audio", "text"],
+                            "instructions": (
+                                f"以下のメッセージを感情を込めて読み上げてください: {message_val}\n"
+                                + _SPEAK_REACTION_INSTRUCTION
+                            ),
+                        }
                     }
-                }
-                await ws.send(json.dumps(speak_event))
+                    await ws.send(orjson.dumps(speak_event).decode())
+                else:
+                    # メッセージなしの場合は内容が固定なので組み立て済みのJSONを送る
+                    await ws.send(_SPEAK_RESULT_ONLY_JSON)
 
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             LOGGER.error("Function call JSON parse error: %s", e, exc_info=True)
         except Exception as e:
             LOGGER.error("Function execution error: %s", e, exc_info=True)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvicorn[standard] が入っていれば uvloop / httptools を自動選択（未導入環境では asyncio / h11 で起動）
+    # クライアント側WebSocketもpermessage-deflateを無効化（同じ内容を接続ごとに再圧縮しない。ws実装は自動選択のままで有効）
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        ws_per_message_deflate=False,
+        log_level=LOG_LEVEL.lower(),
+    )
@@ -1,13 +1,18 @@
 import os
 import json
 import time
+import hashlib
+import queue
 import threading
 import subprocess
 from pathlib import Path
 from datetime import datetime
-from flask import Flask, render_template, jsonify, send_file, Response
+from urllib.parse import unquote_plus
+from flask import Flask, render_template, Response
 
 import boto3
+import orjson
+from botocore.config import Config
 from dotenv import load_dotenv
 
 from voicevox_client import VoicevoxClient
@@ -18,6 +23,10 @@ load_dotenv()
 AWS_REGION = os.getenv("AWS_REGION", "ap-northeast-1")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "wackathon-2025-trash-images")
 VOICE_BUCKET_NAME = os.getenv("VOICE_BUCKET_NAME", "wackathon-2025-voice-responses")
+# results/ の s3:ObjectCreated:* 通知を受けるSQSキュー（未設定時は list_objects_v2 でポーリング）
+RESULT_QUEUE_URL = os.getenv("RESULT_QUEUE_URL")
+SQS_WAIT_TIME_SECONDS = 20  # ロングポーリングの最大待機時間
+SQS_PENDING_WAIT_TIME_SECONDS = 1  # 未確定のDBバッファがある間の待機時間（バッファの経過時間でフラッシュするため短くする）
 
 import sys
 # config.pyをインポートできるようにパスを追加
@@ -29,29 +38,92 @@ from config import MFA_CREDENTIALS_CACHE
 app = Flask(__name__)
 voicevox = VoicevoxClient()
 
-def get_s3_client():
-    """キャッシュされた認証情報を使用してS3クライアントを作成"""
+# ポーリング間でTLS接続を使い回す（SQSのロングポーリングより長い読み取りタイムアウト）
+AWS_CLIENT_CONFIG = Config(
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=SQS_WAIT_TIME_SECONDS + 10,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+)
+CREDENTIALS_REFRESH_MARGIN_SECONDS = 60  # 有効期限のこの秒数前にクライアントを作り直す
+
+def load_cached_credentials():
+    """キャッシュされた一時認証情報を読み込む（期限切れの場合はNone）"""
+    if not MFA_CREDENTIALS_CACHE.exists():
+        print("⚠️ 認証情報キャッシュが見つかりません")
+        return None
+
+    with open(MFA_CREDENTIALS_CACHE, "r") as f:
+        creds = json.load(f)
+
+    expiration = datetime.fromisoformat(creds["Expiration"])
+    if (expiration - datetime.now(expiration.tzinfo)).total_seconds() <= CREDENTIALS_REFRESH_MARGIN_SECONDS:
+        print("⚠️ キャッシュされた認証情報の有効期限が切れています")
+        return None
+
+    creds["Expiration"] = expiration
+    return creds
+
+def get_aws_client(service: str, creds: dict):
+    """キャッシュされた認証情報を使用してAWSクライアントを作成"""
     try:
-        if not MFA_CREDENTIALS_CACHE.exists():
-            print("⚠️ 認証情報キャッシュが見つかりません")
-            return None
-            
-        with open(MFA_CREDENTIALS_CACHE, "r") as f:
-            creds = json.load(f)
-            
         return boto3.client(
-            "s3",
+            service,
             aws_access_key_id=creds["AccessKeyId"],
             aws_secret_access_key=creds["SecretAccessKey"],
             aws_session_token=creds["SessionToken"],
-            region_name=AWS_REGION
+            region_name=AWS_REGION,
+            config=AWS_CLIENT_CONFIG
         )
     except Exception as e:
-        print(f"⚠️ S3クライアント作成エラー: {e}")
+        print(f"⚠️ {service}クライアント作成エラー: {e}")
         return None
 
-# 初期クライアント（起動時にチェックはしない、スレッド内でやる）
-# s3 = get_s3_client()
+def receive_result_key(sqs_client, wait_time_seconds=SQS_WAIT_TIME_SECONDS):
+    """
+    SQSをロングポーリングして新しい結果JSONのキーを取得する
+
+    Returns:
+        (S3キー, ReceiptHandle) のタプル。新着がなければ (None, None)
+    """
+    response = sqs_client.receive_message(
+        QueueUrl=RESULT_QUEUE_URL,
+        WaitTimeSeconds=wait_time_seconds,
+        MaxNumberOfMessages=1,
+    )
+    messages = response.get("Messages", [])
+    if not messages:
+        return None, None
+
+    message = messages[0]
+    receipt_handle = message["ReceiptHandle"]
+    body = orjson.loads(message["Body"])
+    # SNS経由の場合は Message にS3イベントが包まれている
+    if "Message" in body:
+        body = orjson.loads(body["Message"])
+
+    for record in body.get("Records", []):
+        if record.get("eventName", "").startswith("ObjectCreated"):
+            # S3イベントのキーはURLエンコードされている
+            return unquote_plus(record["s3"]["object"]["key"]), receipt_handle
+
+    # テストイベントなど処理対象外のメッセージは削除して読み捨てる
+    sqs_client.delete_message(QueueUrl=RESULT_QUEUE_URL, ReceiptHandle=receipt_handle)
+    return None, None
+
+def find_latest_result_key(s3_client):
+    """list_objects_v2 で results/ の最新キーを探す（SQS未設定時のフォールバック）"""
+    response = s3_client.list_objects_v2(
+        Bucket=VOICE_BUCKET_NAME,
+        Prefix="results/"
+    )
+
+    if "Contents" not in response:
+        return None
+
+    # 更新日時が最新のものを取得（全体をソートする必要はない）
+    latest_obj = max(response["Contents"], key=lambda x: x["LastModified"])
+    return latest_obj["Key"]
 
 # 状態管理
 current_state = {
@@ -63,54 +135,124 @@ current_state = {
 
 # このファイルのディレクトリを基準にする
 BASE_DIR = Path(__file__).parent
+# static/ 配下なので /static/audio/<filename> としてFlaskの静的配信で返す
 AUDIO_DIR = BASE_DIR / "static" / "audio"
 AUDIO_DIR.mkdir(parents=True, exist_ok=True)
 
+# 再生待ちの音声（1件のみ保持。再生中に届いた古い音声は溜めない）
+playback_queue: "queue.Queue[Path]" = queue.Queue(maxsize=1)
+
+def playback_worker():
+    """Macのスピーカーで音声を順に再生するスレッド（監視ループをブロックしない）"""
+    while True:
+        filepath = playback_queue.get()
+        try:
+            print("🔊 Macで再生中...")
+            subprocess.run(["afplay", str(filepath)], check=False)
+        except Exception as e:
+            print(f"⚠️ 音声再生エラー: {e}")
+
+def get_or_generate_audio(message: str, speaker_id: int):
+    """
+    メッセージに対応する音声ファイルを取得（なければVoicevoxで生成）
+
+    ファイル名をメッセージのハッシュにすることで、同じ文言は再起動後も
+    既存のWAVを再利用し、Voicevoxへの問い合わせとファイル書き込みを省く。
+
+    Returns:
+        音声ファイルのパス、生成失敗時はNone
+    """
+    digest = hashlib.sha1(f"{speaker_id}:{message}".encode("utf-8")).hexdigest()[:16]
+    filepath = AUDIO_DIR / f"voice_{digest}.wav"
+    if filepath.exists():
+        print(f"♻️ 音声キャッシュを使用: {filepath.name}")
+        return filepath
+
+    audio_data = voicevox.generate_audio(message, speaker_id=speaker_id)
+    if not audio_data:
+        return None
+
+    # 書き込み途中のファイルをキャッシュとして拾わないよう一時ファイル経由で保存
+    tmp_path = filepath.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(audio_data)
+    tmp_path.replace(filepath)
+    return filepath
+
 def poll_s3_results():
     """バックグラウンドでS3を監視するスレッド"""
     print("🚀 S3監視スレッドを開始しました")
     s3_client = None
+    sqs_client = None
+    credentials_expiration = None
+
+    # DB初期化（連続して届いた結果はまとめて書き込む）
+    db = Database(batch_writes=True)
+    # DBバッファに積んだ結果のSQSメッセージ（フラッシュで書き込みが確定するまで削除しない）
+    pending_receipts = []
+
+    def flush_and_ack():
+        """バッファを書き込み、成功した場合だけ対応するメッセージを削除する"""
+        if db.flush():
+            for handle in pending_receipts:
+                sqs_client.delete_message(QueueUrl=RESULT_QUEUE_URL, ReceiptHandle=handle)
+        else:
+            # 書き込めなかった分は可視性タイムアウト後にSQSから再配信される
+            print(f"⚠️ DB書き込みに失敗したため {len(pending_receipts)} 件のメッセージを再配信に回します")
+        pending_receipts.clear()
 
-    # DB初期化
-    db = Database()
-    
     while True:
+        receipt_handle = None
         try:
+            # 認証情報の期限が近ければ、エラーを待たずにクライアントを作り直す
+            if credentials_expiration is not None:
+                remaining = (credentials_expiration - datetime.now(credentials_expiration.tzinfo)).total_seconds()
+                if remaining <= CREDENTIALS_REFRESH_MARGIN_SECONDS:
+                    print("🔄 認証情報の期限が近いため再読み込みします...")
+                    s3_client = None
+                    sqs_client = None
+                    credentials_expiration = None
+
             # クライアントがない、または再生成が必要な場合
-            if s3_client is None:
-                s3_client = get_s3_client()
-                if s3_client is None:
+            if s3_client is None or (RESULT_QUEUE_URL and sqs_client is None):
+                creds = load_cached_credentials()
+                if creds is not None:
+                    s3_client = get_aws_client("s3", creds)
+                    if RESULT_QUEUE_URL:
+                        sqs_client = get_aws_client("sqs", creds)
+                if s3_client is None or (RESULT_QUEUE_URL and sqs_client is None):
                     # 認証情報がまだない場合は待機
                     print("Waiting for fresh credentials...")
                     time.sleep(5)
                     continue
-                print("✅ S3クライアントをロードしました")
+                credentials_expiration = creds["Expiration"]
+                print("✅ AWSクライアントをロードしました")
 
-            # 最新のJSON結果を取得
-            response = s3_client.list_objects_v2(
-                Bucket=VOICE_BUCKET_NAME,
-                Prefix="results/"
-            )
-            
-            if "Contents" not in response:
-                time.sleep(1)
-                continue
-
-            # 更新日時でソートして最新を取得
-            latest_obj = sorted(
-                response["Contents"], 
-                key=lambda x: x["LastModified"], 
-                reverse=True
-            )[0]
-            
-            key = latest_obj["Key"]
-            
-            # 初回起動時は最新のキーを記録するだけで処理はしない
-            if current_state["last_processed_key"] is None:
-                current_state["last_processed_key"] = key
-                print(f"✅ 初期状態を設定: 最新のキーは {key} です（これは再生しません）")
-                time.sleep(1)
-                continue
+            if RESULT_QUEUE_URL:
+                # 新しい結果が届くまでブロック（届かなければ WaitTimeSeconds で戻る）
+                # 未確定のバッファがある間は短く待ち、経過時間によるフラッシュを遅らせない
+                wait = SQS_PENDING_WAIT_TIME_SECONDS if pending_receipts else SQS_WAIT_TIME_SECONDS
+                key, receipt_handle = receive_result_key(sqs_client, wait)
+                if key is None:
+                    # 新着がない間にバッファ済みのレコードを確定させる
+                    flush_and_ack()
+                    continue
+            else:
+                # 最新のJSON結果を取得
+                key = find_latest_result_key(s3_client)
+                if key is None or key == current_state["last_processed_key"]:
+                    # 新着がない間にバッファ済みのレコードを確定させる
+                    db.flush()
+                if key is None:
+                    time.sleep(1)
+                    continue
+
+                # 初回起動時は最新のキーを記録するだけで処理はしない
+                if current_state["last_processed_key"] is None:
+                    current_state["last_processed_key"] = key
+                    print(f"✅ 初期状態を設定: 最新のキーは {key} です（これは再生しません）")
+                    time.sleep(1)
+                    continue
             
             # 新しいファイルが見つかった場合
             if key != current_state["last_processed_key"]:
@@ -118,13 +260,15 @@ def poll_s3_results():
                 
                 # JSONをダウンロード
                 obj = s3_client.get_object(Bucket=VOICE_BUCKET_NAME, Key=key)
-                data = json.loads(obj["Body"].read().decode("utf-8"))
+                # 元のバイト列はDBの raw_json にそのまま保存する（再シリアライズしない）
+                body_bytes = obj["Body"].read()
+                data = orjson.loads(body_bytes)
                 
                 # DBに記録
                 try:
                     # S3キーから画像パスを推測（簡易的）
                     # 実際にはLambdaの結果に画像パスを含めるのがベストだが、今はキーを記録
-                    db.insert_record(image_path=key, result_json=data)
+                    db.insert_record(image_path=key, result_json=data, raw_json=body_bytes)
                 except Exception as e:
                     print(f"⚠️ DB保存エラー: {e}")
 
@@ -135,14 +279,10 @@ def poll_s3_results():
                     print(f"🗣️ 音声生成開始: {message}")
                     # Voicevoxで音声生成
                     # 話者ID 3: ずんだもん（ノーマル）
-                    audio_data = voicevox.generate_audio(message, speaker_id=3)
+                    filepath = get_or_generate_audio(message, speaker_id=3)
                     
-                    if audio_data:
-                        # ファイル保存
-                        filename = f"voice_{int(time.time())}.wav"
-                        filepath = AUDIO_DIR / filename
-                        with open(filepath, "wb") as f:
-                            f.write(audio_data)
+                    if filepath:
+                        filename = filepath.name
                         
                         # 状態更新
                         current_state["last_processed_key"] = key
@@ -151,14 +291,21 @@ def poll_s3_results():
                         current_state["timestamp"] = timestamp
                         print(f"✅ 音声生成完了: {filename}")
                         
-                        # Macで音声を再生
+                        # Macで音声を再生（再生スレッドに渡すだけで待たない）
                         try:
-                            print("🔊 Macで再生中...")
-                            subprocess.run(["afplay", str(filepath)], check=False)
-                        except Exception as e:
-                            print(f"⚠️ 音声再生エラー: {e}")
+                            playback_queue.put_nowait(filepath)
+                        except queue.Full:
+                            print("⚠️ 再生待ちの音声があるためスキップします")
                     else:
                         print("❌ 音声生成失敗")
+
+            # 処理が終わったメッセージはDB書き込みの確定後に削除（例外時は可視性タイムアウト後に再配信される）
+            if receipt_handle:
+                pending_receipts.append(receipt_handle)
+                if db.flush_due():
+                    flush_and_ack()
+            elif db.flush_due():
+                db.flush()
                 
         except Exception as e:
             error_msg = str(e)
@@ -168,9 +315,14 @@ def poll_s3_results():
             if "ExpiredToken" in error_msg or "AccessDenied" in error_msg:
                 print("🔄 認証情報が無効です。再読み込みを待機します...")
                 s3_client = None
+                sqs_client = None
+                credentials_expiration = None
                 time.sleep(5)
+            elif RESULT_QUEUE_URL:
+                time.sleep(1)  # エラー時の連続リトライを抑制
         
-        time.sleep(1)  # 1秒間隔でポーリング
+        if not RESULT_QUEUE_URL:
+            time.sleep(1)  # 1秒間隔でポーリング
 
 @app.route("/")
 def index():
@@ -179,21 +331,19 @@ def index():
 @app.route("/status")
 def status():
     """現在の状態を返す（ポーリング用）"""
-    return jsonify({
+    return Response(orjson.dumps({
         "audio_file": current_state["current_audio_file"],
         "message": current_state["message"],
         "timestamp": current_state["timestamp"]
-    })
-
-@app.route("/audio/<filename>")
-def get_audio(filename):
-    """音声ファイルを配信"""
-    return send_file(AUDIO_DIR / filename, mimetype="audio/wav")
+    }), mimetype="application/json")
 
 if __name__ == "__main__":
     # 監視スレッド起動
     thread = threading.Thread(target=poll_s3_results, daemon=True)
     thread.start()
+
+    # 音声再生スレッド起動
+    threading.Thread(target=playback_worker, daemon=True).start()
     
     # サーバー起動 (全インターフェースで待受)
     app.run(host="0.0.0.0", port=5001, debug=False)
@@ -7,14 +7,23 @@ S3にアップロードします。
 import json
 import os
 import sys
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 import boto3
 import cv2
 from botocore.exceptions import ClientError, NoCredentialsError
 
+# libjpeg-turbo (SIMD) によるJPEGエンコード。未インストールなら cv2.imencode を使う
+try:
+    from turbojpeg import TJPF_BGR, TurboJPEG
+
+    _TURBO_JPEG: Optional["TurboJPEG"] = TurboJPEG()
+except Exception:
+    _TURBO_JPEG = None
+
 from config import (
     AWS_ACCESS_KEY_ID,
     AWS_REGION,
@@ -28,20 +37,60 @@ from config import (
     MFA_CREDENTIALS_CACHE,
     MFA_SERIAL_NUMBER,
     S3_BUCKET_NAME,
+    SAVE_LOCAL_COPY,
 )
 
 
+def encode_image(frame) -> Optional[bytes]:
+    """
+    フレームを IMAGE_FORMAT でエンコード
+
+    PyTurboJPEG が利用可能な場合はそちらでJPEGエンコードする。
+
+    Returns:
+        エンコード済み画像データ、失敗時はNone
+    """
+    if _TURBO_JPEG is not None and IMAGE_FORMAT in ("jpg", "jpeg"):
+        return _TURBO_JPEG.encode(frame, quality=IMAGE_QUALITY, pixel_format=TJPF_BGR)
+
+    encode_params = [cv2.IMWRITE_JPEG_QUALITY, IMAGE_QUALITY]
+    success, buffer = cv2.imencode(f".{IMAGE_FORMAT}", frame, encode_params)
+    if not success:
+        return None
+    return buffer.tobytes()
+
+
+def get_camera_backend() -> int:
+    """
+    プラットフォームに応じたVideoCaptureバックエンドを返す
+
+    Returns:
+        cv2.CAP_* 定数（不明なOSでは自動選択の cv2.CAP_ANY）
+    """
+    if sys.platform == "darwin":
+        return cv2.CAP_AVFOUNDATION
+    if sys.platform.startswith("win"):
+        return cv2.CAP_DSHOW
+    if sys.platform.startswith("linux"):
+        return cv2.CAP_V4L2
+    return cv2.CAP_ANY
+
+
 class MFACameraToS3Uploader:
     """MFA認証を使用したカメラ画像のS3アップローダー"""
 
     def __init__(self) -> None:
         """初期化処理"""
         # カメラの初期化
-        self.camera = cv2.VideoCapture(CAMERA_DEVICE_ID)
+        self.camera = cv2.VideoCapture(CAMERA_DEVICE_ID, get_camera_backend())
         if not self.camera.isOpened():
             raise RuntimeError(f"カメラデバイス {CAMERA_DEVICE_ID} を開けません")
 
-        # カメラ設定
+        # 内部バッファを最小にして、古いフレームが溜まらないようにする
+        self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # カメラ設定（MJPG対応カメラではYUV→BGR変換をドライバ側に任せる）
+        self.camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
         self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, IMAGE_WIDTH)
         self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, IMAGE_HEIGHT)
 
@@ -212,40 +261,52 @@ class MFACameraToS3Uploader:
             print(f"❌ S3クライアント作成エラー: {str(e)}")
             return None
 
-    def capture_image(self) -> Optional[str]:
+    def capture_image(self) -> Optional[Tuple[str, bytes]]:
         """
-        カメラで画像をキャプチャしてローカルに保存
+        カメラで画像をキャプチャしてメモリ上でエンコード
 
         Returns:
-            保存した画像のファイルパス、失敗時はNone
+            (ファイル名, エンコード済み画像データ) のタプル、失敗時はNone
         """
+        # 撮影間隔の間にバッファに残った古いフレームをデコードせずに捨てる
+        self.camera.grab()
         ret, frame = self.camera.read()
         if not ret:
             print("❌ カメラからの画像取得に失敗しました")
             return None
 
-        # タイムスタンプ付きファイル名を生成
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"trash_image_{timestamp}.{IMAGE_FORMAT}"
-        filepath = self.local_dir / filename
+        # 解像度指定を無視してネイティブ解像度を返すドライバがあるため、エンコード前に縮小
+        if frame.shape[1] != IMAGE_WIDTH or frame.shape[0] != IMAGE_HEIGHT:
+            frame = cv2.resize(frame, (IMAGE_WIDTH, IMAGE_HEIGHT), interpolation=cv2.INTER_AREA)
 
-        # 画像を保存
-        encode_params = [cv2.IMWRITE_JPEG_QUALITY, IMAGE_QUALITY]
-        success = cv2.imwrite(str(filepath), frame, encode_params)
+        # タイムスタンプ付きファイル名を生成（ナノ秒の整数値なので同一秒内でも衝突しない）
+        timestamp = time.time_ns()
+        filename = f"trash_image_{timestamp}.{IMAGE_FORMAT}"
 
-        if success:
-            print(f"✅ 画像をキャプチャ: {filepath}")
-            return str(filepath)
-        else:
-            print(f"❌ 画像の保存に失敗: {filepath}")
+        # ディスクを経由せずメモリ上でエンコード
+        image_data = encode_image(frame)
+        if image_data is None:
+            print(f"❌ 画像のエンコードに失敗: {filename}")
             return None
 
-    def upload_to_s3(self, filepath: str) -> bool:
+        print(f"✅ 画像をキャプチャ: {filename} ({len(image_data)} bytes)")
+
+        if SAVE_LOCAL_COPY:
+            filepath = self.local_dir / filename
+            try:
+                filepath.write_bytes(image_data)
+            except OSError as e:
+                print(f"⚠️ ローカル保存に失敗: {filepath} ({str(e)})")
+
+        return filename, image_data
+
+    def upload_to_s3(self, filename: str, image_data: bytes) -> bool:
         """
         画像をS3にアップロード
 
         Parameters:
-            filepath: アップロードする画像のローカルパス
+            filename: S3上のファイル名
+            image_data: アップロードする画像データ
 
         Returns:
             アップロード成功時True、失敗時False
@@ -254,23 +315,18 @@ class MFACameraToS3Uploader:
         if not s3_client:
             return False
 
-        filename = Path(filepath).name
         s3_key = f"images/{filename}"
 
         try:
-            s3_client.upload_file(
-                filepath,
-                S3_BUCKET_NAME,
-                s3_key,
-                ExtraArgs={"ContentType": f"image/{IMAGE_FORMAT}"},
+            s3_client.put_object(
+                Bucket=S3_BUCKET_NAME,
+                Key=s3_key,
+                Body=image_data,
+                ContentType=f"image/{IMAGE_FORMAT}",
             )
             print(f"✅ S3アップロード成功: s3://{S3_BUCKET_NAME}/{s3_key}")
             return True
 
-        except FileNotFoundError:
-            print(f"❌ ファイルが見つかりません: {filepath}")
-            return False
-
         except ClientError as e:
             error_code = e.response["Error"]["Code"]
             error_message = e.response["Error"]["Message"]
@@ -293,12 +349,13 @@ class MFACameraToS3Uploader:
         print("=" * 60)
 
         # 画像をキャプチャ
-        filepath = self.capture_image()
-        if not filepath:
+        captured = self.capture_image()
+        if not captured:
             return False
 
         # S3にアップロード
-        success = self.upload_to_s3(filepath)
+        filename, image_data = captured
+        success = self.upload_to_s3(filename, image_data)
 
         if success:
             print("\n✅ 処理が正常に完了しました")
@@ -355,7 +412,6 @@ def main() -> int:
                 return 1
 
         # 連続実行
-        import time
         from config import CAPTURE_INTERVAL_SECONDS
 
         print(f"\n🚀 連続撮影モードを開始します（間隔: {CAPTURE_INTERVAL_SECONDS}秒）")
@@ -21,6 +21,7 @@ BASE_DIR = Path(__file__).parent
 LOCAL_SAVE_DIR: Final[Path] = BASE_DIR / "captured_images"  # 画像保存ディレクトリ
 IMAGE_FORMAT: Final[str] = "jpg"  # 画像フォーマット（jpg, png）
 IMAGE_QUALITY: Final[int] = 95  # JPEG品質（1-100、高いほど高品質）
+SAVE_LOCAL_COPY: Final[bool] = True  # アップロード画像のコピーをローカルにも保存するか（デバッグ用）
 
 # AWS S3設定（環境変数から読み込み、またはここで直接設定）
 import os
@@ -1,18 +1,31 @@
 import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+def probe_camera(device_id):
+    """1台分のカメラを開いて映像が取得できるか確認する"""
+    cap = cv2.VideoCapture(device_id)
+    if not cap.isOpened():
+        return device_id, False, False, 0, 0
+    ret, frame = cap.read()
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return device_id, True, ret, width, height
 
 def list_cameras(max_check=10):
     print("カメラデバイスを検索中...")
     available_cameras = []
-    for i in range(max_check):
-        cap = cv2.VideoCapture(i)
-        if cap.isOpened():
-            ret, frame = cap.read()
+    # デバイスごとのオープン待ちが直列に積み重ならないよう並列に確認する
+    with ThreadPoolExecutor(max_workers=max_check) as executor:
+        results = list(executor.map(probe_camera, range(max_check)))
+
+    for i, opened, ret, width, height in results:
+        if opened:
             if ret:
-                print(f"[OK] Device ID {i}: カメラを開けました ({int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))})")
+                print(f"[OK] Device ID {i}: カメラを開けました ({width}x{height})")
                 available_cameras.append(i)
             else:
                 print(f"[NG] Device ID {i}: カメラは開けましたが、映像が取得できませんでした")
-            cap.release()
         else:
             pass
             # print(f"[--] Device ID {i}: カメラが見つかりません")